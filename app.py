@@ -4,6 +4,8 @@ import pandas as pd
 import os
 import json
 import re
+import base64
+import hmac
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from functools import wraps
@@ -16,12 +18,15 @@ from werkzeug.security import generate_password_hash, check_password_hash
 # --- IMPORTACIÓN CORREGIDA ---
 # Se asegura de importar las funciones necesarias de los otros archivos.
 from modules.pdf_generator import generar_certificado_en_memoria
+from modules.response_cache import ResponseCache
+from modules.export_writer import iter_csv, iter_xlsx
+from modules.dashboard_series import count_periods, resample_counts, TooManyPeriods, SERIES_GRANULARITIES, SERIES_MAX_PERIODS
 
 # Cargar variables de entorno del archivo .env
 load_dotenv()
 
 # Importar nuestro gestor de datos después de cargar las variables
-from modules.google_sheets_manager import GoogleSheetManager, get_column_order
+from modules.storage_backends import create_storage_backend, get_column_order
 
 # Inicializar la App y el Gestor de Datos
 app = Flask(__name__)
@@ -67,11 +72,21 @@ if not all([google_client_id, google_client_secret]):
 limiter = Limiter(get_remote_address, app=app, default_limits=["200 per day", "50 per hour"], storage_uri="memory://")
 
 try:
-    data_manager = GoogleSheetManager()
+    # STORAGE_BACKEND elige dónde se guardan los datos: 'sheets' (por defecto), 'sqlite' o 'memory'.
+    data_manager = create_storage_backend()
+    # Precarga de productos, especificaciones, usuarios y certificados en segundo plano.
+    # Con gunicorn --preload se hace en el proceso maestro antes de crear los workers.
+    data_manager.start_warm_up()
 except Exception as e:
-    print(f"Error Crítico al iniciar GoogleSheetManager: {e}")
+    print(f"Error Crítico al iniciar el gestor de datos: {e}")
     data_manager = None
 
+# Segundos que una petición espera a que termine la precarga antes de seguir sin ella.
+WARM_UP_WAIT_TIMEOUT = float(os.getenv('WARM_UP_WAIT_TIMEOUT', '30'))
+
+# Respuestas ya renderizadas de las búsquedas en vivo (registros y productos).
+ajax_cache = ResponseCache(int(os.getenv('AJAX_CACHE_SIZE', '256')))
+
 # --- Manejador de Errores Personalizado ---
 @app.errorhandler(429)
 def ratelimit_handler(e):
@@ -96,6 +111,49 @@ def supervisor_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+# --- Autenticación de la API ---
+# Claves para integraciones (ERP, LIMS) en API_KEYS, con el formato "usuario:clave,usuario2:clave2".
+# Cada clave actúa en nombre de un usuario existente y con su ROL actual: si el usuario
+# se elimina o cambia de rol, la clave deja de funcionar o pierde permisos al momento.
+API_KEYS = [tuple(item.strip().split(':', 1)) for item in os.getenv('API_KEYS', '').split(',') if ':' in item]
+API_ROLES = ('Administrador', 'Supervisor', 'Operario')
+
+def api_user():
+    """(usuario, rol) de la petición a la API: sesión del navegador o cabecera 'Authorization: Bearer <clave>'."""
+    if 'username' in session:
+        return session['username'], session.get('role')
+    scheme, _, key = request.headers.get('Authorization', '').partition(' ')
+    if scheme.lower() != 'bearer' or not key.strip() or not data_manager:
+        return None
+    username = None
+    for key_user, api_key in API_KEYS:
+        # Se comparan todas las claves en tiempo constante para no revelar cuál coincide.
+        if hmac.compare_digest(api_key.encode('utf-8'), key.strip().encode('utf-8')):
+            username = key_user
+    user = data_manager.find_user(username) if username else None
+    if not user:
+        return None
+    return user['USERNAME'], user.get('ROL', 'Operario')
+
+def api_login_required(roles=API_ROLES):
+    """Como supervisor_required, pero para la API: responde 401/403 en JSON en lugar de redirigir."""
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            user = api_user()
+            if not user:
+                response = jsonify({'success': False, 'message': 'No autorizado'})
+                response.headers['WWW-Authenticate'] = 'Bearer'
+                return response, 401
+            if user[1] not in roles:
+                return jsonify({'success': False, 'message': 'No tienes permiso para acceder a este recurso'}), 403
+            response = make_response(f(*args, **kwargs))
+            # Las respuestas dependen de quién pregunta: ningún navegador ni proxy debe guardarlas.
+            response.headers['Cache-Control'] = 'no-store'
+            return response
+        return decorated_function
+    return decorator
+
 # --- Función Auxiliar para Fechas ---
 def format_date_for_sheet(date_str_from_form):
     if not date_str_from_form: return ""
@@ -107,9 +165,51 @@ def format_date_for_sheet(date_str_from_form):
         except ValueError:
             return date_str_from_form
 
+def parse_filter_date(date_str):
+    """Convierte la fecha de un filtro (dd-mm-YYYY o YYYY-mm-dd) en date, o None si no es válida."""
+    if not date_str: return None
+    fecha = pd.to_datetime(date_str, dayfirst=True, errors='coerce')
+    return fecha.date() if pd.notna(fecha) else None
+
+def cached_ajax_response(cache_key, render_payload):
+    """
+    Respuesta JSON (búsqueda en vivo, series del dashboard) servida desde ajax_cache.
+
+    `cache_key` debe incluir la versión de los datos; `render_payload()` solo se llama
+    si la respuesta no está en caché. Se envía un ETag fuerte y, si el navegador ya
+    tiene esa misma respuesta (If-None-Match), se contesta 304 sin cuerpo.
+    """
+    body, etag = ajax_cache.get_or_render(cache_key, lambda: json.dumps(render_payload()).encode('utf-8'))
+    response = make_response(body)
+    response.mimetype = 'application/json'
+    response.set_etag(etag)
+    # El navegador puede guardarla pero debe revalidarla siempre; la misma URL sin
+    # X-Requested-With devuelve la página HTML completa.
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.vary.add('X-Requested-With')
+    return response.make_conditional(request)
+
 @app.before_request
 def before_request():
     session.modified = True
+    # Ninguna petición de usuario hace una carga en frío: si la precarga sigue en curso
+    # se espera a que termine en lugar de lanzar lecturas duplicadas.
+    if data_manager and request.endpoint not in ('static', 'healthz') and not data_manager.is_ready:
+        data_manager.wait_until_ready(WARM_UP_WAIT_TIMEOUT)
+
+@app.route('/healthz')
+@limiter.exempt
+def healthz():
+    """
+    Comprobación de estado para Render: responde 503 hasta que termina la precarga.
+
+    Queda fuera de los límites por defecto (50 por hora): Render la consulta cada pocos
+    segundos y un 429 marcaría la instancia como caída.
+    """
+    if not data_manager:
+        return jsonify({'listo': False}), 503
+    listo = data_manager.wait_until_ready(0)
+    return jsonify({'listo': listo}), 200 if listo else 503
 
 # --- Rutas de Autenticación ---
 @app.route('/login', methods=['GET', 'POST'])
@@ -122,9 +222,8 @@ def login():
         username = request.form.get('username')
         password = request.form.get('password')
         
-        users = data_manager.get_all_users()
-        # Se busca el usuario por nombre de usuario
-        user_found = next((u for u in users if u.get('USERNAME') == username), None)
+        # Se busca el usuario por nombre de usuario en el directorio en memoria
+        user_found = data_manager.find_user(username)
 
         # Se verifica el usuario y la contraseña hasheada
         if user_found and check_password_hash(user_found.get('PASSWORD', ''), password):
@@ -196,8 +295,7 @@ def auth_google():
             return redirect(url_for('login'))
 
         # 2. Busca al usuario en tu hoja de "Usuarios" para obtener su rol
-        all_users = data_manager.get_all_users()
-        user_in_sheet = next((u for u in all_users if u.get('USERNAME').lower() == user_email.lower()), None)
+        user_in_sheet = data_manager.find_user(user_email)
 
         # --- INICIO DE LA MODIFICACIÓN: Auto-registro de usuarios ---
         # Si el usuario no está en la hoja de cálculo pero tiene un dominio válido,
@@ -249,69 +347,40 @@ def registros():
     page = request.args.get('page', 1, type=int)
     per_page = 20
 
-    all_records = data_manager.get_all_records()
-
-    # --- INICIO DE LA CORRECCIÓN: Convertir fechas de registro a objetos datetime ---
-    # Esto es necesario para poder filtrar por rango de fechas.
-    for record in all_records:
-        try:
-            record['FECHA_DE_REGISTRO_DT'] = datetime.strptime(record.get('FECHA_DE_REGISTRO', ''), '%d-%m-%Y %H:%M:%S')
-        except (ValueError, TypeError):
-            record['FECHA_DE_REGISTRO_DT'] = None
-    
-    # Se eliminan los registros que no tienen una fecha válida para evitar errores.
-    all_records = [r for r in all_records if r['FECHA_DE_REGISTRO_DT'] is not None]
-    # --- FIN DE LA CORRECCIÓN ---
-
-    # --- INICIO DE LA CORRECCIÓN ---
-    # Se invierte la lista de registros para que los más nuevos (los últimos de la hoja)
-    # aparezcan primero. Esto es más robusto que ordenar por fecha si hay formatos inconsistentes.
-    all_records.reverse()
-    # Se crea una copia para aplicar los filtros.
-    filtered_records = all_records[:]
-    # --- FIN DE LA CORRECCIÓN ---
-
-    if search_term:
-        # --- INICIO DE LA CORRECCIÓN ---
-        # Se divide el término de búsqueda por espacios para permitir filtros múltiples.
-        # Ej: "APROBADO AMOXICILINA" buscará registros que contengan ambas palabras.
-        search_parts = search_term.split()
-        filtered_records = [
-            rec for rec in filtered_records if all(
-                any(part in str(val).lower() for val in rec.values()) for part in search_parts
-            )
-        ]
-        # --- FIN DE LA CORRECCIÓN ---
-    
-    # --- INICIO DE LA CORRECCIÓN: Filtrado por rango de fechas ---
-    if fecha_inicio_str:
-        fecha_inicio = pd.to_datetime(fecha_inicio_str, dayfirst=True, errors='coerce')
-        if pd.notna(fecha_inicio):
-            filtered_records = [r for r in filtered_records if r['FECHA_DE_REGISTRO_DT'].date() >= fecha_inicio.date()]
-    
-    if fecha_fin_str:
-        fecha_fin = pd.to_datetime(fecha_fin_str, dayfirst=True, errors='coerce')
-        if pd.notna(fecha_fin):
-            filtered_records = [r for r in filtered_records if r['FECHA_DE_REGISTRO_DT'].date() <= fecha_fin.date()]
-    # --- FIN DE LA CORRECCIÓN ---
-
-    # 3. Aplicar paginación a los registros (ya filtrados si es el caso)
-    total_records = len(filtered_records)
-    start = (page - 1) * per_page
-    end = start + per_page
-    paginated_records = filtered_records[start:end]
-    total_pages = (total_records + per_page - 1) // per_page
+    # --- INICIO DE LA MODIFICACIÓN: Lectura desde la réplica ---
+    # La búsqueda (varias palabras separadas por espacio, todas deben aparecer), el rango
+    # de fechas y la paginación se resuelven en data_manager.query_records, que usa
+    # consultas indexadas sobre la réplica SQLite. Los registros llegan del más nuevo al
+    # más antiguo y se excluyen los que no tienen una fecha de registro válida.
+    def query_page():
+        return data_manager.query_records(
+            search_term=search_term,
+            fecha_inicio=parse_filter_date(fecha_inicio_str),
+            fecha_fin=parse_filter_date(fecha_fin_str),
+            limit=per_page,
+            offset=max(page - 1, 0) * per_page
+        )
     # --- FIN DE LA MODIFICACIÓN ---
 
     # --- INICIO DE LA NUEVA LÓGICA ---
     # Si la solicitud es AJAX (viene de nuestro script de búsqueda), devolvemos solo los datos necesarios en formato JSON.
+    # La respuesta se guarda por consulta y versión de los datos: repetir una búsqueda
+    # no vuelve a filtrar ni a renderizar, y el navegador recibe 304 si ya la tiene.
     if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
-        return jsonify({
-            'table_html': render_template('_registros_table_rows.html', records=paginated_records),
-            'pagination_html': render_template('_pagination.html', current_page=page, total_pages=total_pages, search_term=search_term, fecha_inicio=fecha_inicio_str, fecha_fin=fecha_fin_str)
-        })
+        def render_payload():
+            records, total = query_page()
+            total_pages = (total + per_page - 1) // per_page
+            return {
+                'table_html': render_template('_registros_table_rows.html', records=records),
+                'pagination_html': render_template('_pagination.html', current_page=page, total_pages=total_pages, search_term=search_term, fecha_inicio=fecha_inicio_str, fecha_fin=fecha_fin_str)
+            }
+        cache_key = ('registros', search_term, fecha_inicio_str, fecha_fin_str, page, data_manager.records_version)
+        return cached_ajax_response(cache_key, render_payload)
     # --- FIN DE LA NUEVA LÓGICA ---
 
+    paginated_records, total_records = query_page()
+    total_pages = (total_records + per_page - 1) // per_page
+
     # Si es una carga de página normal, renderizamos la plantilla completa.
     return render_template('registros.html', 
                            records=paginated_records, 
@@ -321,6 +390,55 @@ def registros():
                            current_page=page, 
                            total_pages=total_pages)
 
+# Certificados que se leen de cada vez al exportar (ver iter_filtered_records).
+EXPORT_BATCH_SIZE = 500
+EXPORT_MIMETYPES = {
+    'csv': 'text/csv',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+
+def iter_filtered_records(**filters):
+    """Recorre todos los certificados filtrados por páginas de cursor, sin cargarlos todos a la vez."""
+    after = None
+    while True:
+        rows = data_manager.query_records_after(after=after, limit=EXPORT_BATCH_SIZE, **filters)
+        for _, record in rows:
+            yield record
+        if len(rows) < EXPORT_BATCH_SIZE:
+            return
+        after = rows[-1][0]
+
+@app.route('/exportar-registros/<string:formato>')
+def exportar_registros(formato):
+    """Descarga en CSV o XLSX todos los certificados que cumplen los filtros del listado."""
+    if 'username' not in session:
+        return redirect(url_for('login'))
+    if not data_manager:
+        flash("Error: No se pudo conectar con el gestor de datos.", "danger")
+        return redirect(url_for('registros'))
+    if formato not in EXPORT_MIMETYPES:
+        flash(f"Formato de exportación no soportado: {formato}", "danger")
+        return redirect(url_for('registros'))
+
+    filters = {
+        'search_term': request.args.get('search', '').lower(),
+        'fecha_inicio': parse_filter_date(request.args.get('fecha_inicio', '')),
+        'fecha_fin': parse_filter_date(request.args.get('fecha_fin', '')),
+        'producto': request.args.get('producto') or None,
+    }
+    data_manager.log_action(session.get('username'), f"Exportó Registros ({formato.upper()})",
+                            ", ".join(f"{k}: {v}" for k, v in filters.items() if v))
+
+    # Las filas se generan y se envían a medida que se leen: el archivo completo nunca
+    # está en memoria y el cliente empieza a recibir datos de inmediato.
+    columns = get_column_order()
+    rows = ([record.get(c, '') for c in columns] for record in iter_filtered_records(**filters))
+    body = iter_csv(columns, rows) if formato == 'csv' else iter_xlsx(columns, rows, 'Certificados')
+    response = app.response_class(body, mimetype=EXPORT_MIMETYPES[formato])
+    filename = f"certificados_{datetime.now().strftime('%Y%m%d_%H%M')}.{formato}"
+    response.headers['Content-Disposition'] = f'attachment; filename={filename}'
+    return response
+
 @app.route('/dashboard')
 def dashboard():
     if 'username' not in session: 
@@ -330,31 +448,26 @@ def dashboard():
     fecha_inicio_str = request.args.get('fecha_inicio', '')
     fecha_fin_str = request.args.get('fecha_fin', '')
     
-    all_records = data_manager.get_all_records()
-    df = pd.DataFrame(all_records)
-    
-    if df.empty:
-        product_list = ["Todos los Productos"] + sorted(list(data_manager.product_data.keys()))
-        return render_template('dashboard.html', stats={'total': 0, 'aprobados': 0, 'rechazados': 0, 'pendientes': 0}, chart_labels=[], chart_data=[], monthly_summary=[], product_list=product_list, current_filters={}, target_year=datetime.now().year)
-
-    df['FECHA_DE_REGISTRO_DT'] = pd.to_datetime(df['FECHA_DE_REGISTRO'], errors='coerce', dayfirst=True)
-    df_filtrado_final = df.copy()
-    if producto_filtro and producto_filtro != 'Todos los Productos':
-        df_filtrado_final = df_filtrado_final[df_filtrado_final['PRODUCTO'] == producto_filtro]
-    if fecha_inicio_str:
-        fecha_inicio = pd.to_datetime(fecha_inicio_str, dayfirst=True, errors='coerce')
-        if pd.notna(fecha_inicio):
-            df_filtrado_final = df_filtrado_final[df_filtrado_final['FECHA_DE_REGISTRO_DT'].dt.normalize() >= fecha_inicio]
-    if fecha_fin_str:
-        fecha_fin = pd.to_datetime(fecha_fin_str, dayfirst=True, errors='coerce')
-        if pd.notna(fecha_fin):
-            df_filtrado_final = df_filtrado_final[df_filtrado_final['FECHA_DE_REGISTRO_DT'].dt.normalize() <= fecha_fin]
-
-    stats = df_filtrado_final['CONCLUSION'].value_counts().to_dict()
+    # --- INICIO DE LA MODIFICACIÓN: Recuentos materializados ---
+    # El backend mantiene recuentos por (producto, día de registro, CONCLUSION) que se
+    # actualizan con cada alta o edición; aquí solo se suman unos pocos contadores, sin
+    # recorrer los certificados. Sin filtro de fechas se incluyen los que no tienen fecha.
+    counts = data_manager.summary_counts(
+        producto=producto_filtro if producto_filtro != 'Todos los Productos' else None,
+        fecha_inicio=parse_filter_date(fecha_inicio_str),
+        fecha_fin=parse_filter_date(fecha_fin_str)
+    )
+    conclusion_totals = {}
+    for (_, conclusion), total in counts.items():
+        conclusion_totals[conclusion] = conclusion_totals.get(conclusion, 0) + total
+    # --- FIN DE LA MODIFICACIÓN ---
+
+    # De mayor a menor, como value_counts().
+    stats = dict(sorted(conclusion_totals.items(), key=lambda item: item[1], reverse=True))
     chart_labels = list(stats.keys())
     chart_data = list(stats.values())
     dashboard_stats = {
-        'total': df_filtrado_final.shape[0],
+        'total': sum(stats.values()),
         'aprobados': stats.get('APROBADO', 0),
         'rechazados': stats.get('RECHAZADO', 0),
         'pendientes': stats.get('PENDIENTE', 0)
@@ -368,15 +481,15 @@ def dashboard():
     # --- INICIO DE LA MODIFICACIÓN ---
     # Se determina el año objetivo para el resumen mensual.
     target_year = datetime.now().year
-    if fecha_inicio_str:
-        try:
-            target_year = pd.to_datetime(fecha_inicio_str, dayfirst=True).year
-        except (ValueError, TypeError):
-            pass
-    # Se usa FECHA_DE_REGISTRO_DT para el resumen anual, asegurando consistencia.
-    # AHORA SE USA EL DATAFRAME YA FILTRADO (df_filtrado_final) para el resumen.
-    df_para_resumen_anual = df_filtrado_final[df_filtrado_final['FECHA_DE_REGISTRO_DT'].dt.year == target_year]
-    monthly_summary_raw = df_para_resumen_anual.groupby(df_para_resumen_anual['FECHA_DE_REGISTRO_DT'].dt.month)['CONCLUSION'].value_counts().unstack(fill_value=0)
+    fecha_inicio_filtro = parse_filter_date(fecha_inicio_str)
+    if fecha_inicio_filtro:
+        target_year = fecha_inicio_filtro.year
+    # El resumen anual usa los mismos recuentos ya filtrados, agrupados por mes.
+    monthly_summary_raw = {}
+    for (day, conclusion), total in counts.items():
+        if day is None or day.year != target_year: continue
+        month_counts = monthly_summary_raw.setdefault(day.month, {})
+        month_counts[conclusion] = month_counts.get(conclusion, 0) + total
     # --- FIN DE LA MODIFICACIÓN ---
     
     meses_es = ["Enero", "Febrero", "Marzo", "Abril", "Mayo", "Junio", "Julio", "Agosto", "Septiembre", "Octubre", "Noviembre", "Diciembre"]
@@ -399,8 +512,8 @@ def dashboard():
         }
         # --- FIN DE LA CORRECCIÓN ---
 
-        if month_num in monthly_summary_raw.index:
-            data = monthly_summary_raw.loc[month_num]
+        if month_num in monthly_summary_raw:
+            data = monthly_summary_raw[month_num]
             month_data.update({'aprobado': data.get('APROBADO', 0), 'rechazado': data.get('RECHAZADO', 0), 'pendiente': data.get('PENDIENTE', 0)})
         monthly_summary.append(month_data)
     
@@ -521,7 +634,7 @@ def gestion_productos():
     page = request.args.get('page', 1, type=int)
     per_page = 20
 
-    try:
+    def filter_page():
         productos = data_manager.get_all_products_flat()
 
         if search_term:
@@ -539,13 +652,20 @@ def gestion_productos():
         end = start + per_page
         paginated_records = filtered_productos[start:end]
         total_pages = (total_records + per_page - 1) // per_page
+        return paginated_records, total_pages
 
+    try:
         if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
-            return jsonify({
-                'table_html': render_template('_productos_table_rows.html', productos=paginated_records),
-                'pagination_html': render_template('_pagination.html', current_page=page, total_pages=total_pages, search_term=search_term, endpoint='gestion_productos')
-            })
-
+            def render_payload():
+                paginated_records, total_pages = filter_page()
+                return {
+                    'table_html': render_template('_productos_table_rows.html', productos=paginated_records),
+                    'pagination_html': render_template('_pagination.html', current_page=page, total_pages=total_pages, search_term=search_term, endpoint='gestion_productos')
+                }
+            cache_key = ('productos', search_term, page, data_manager.products_version)
+            return cached_ajax_response(cache_key, render_payload)
+
+        paginated_records, total_pages = filter_page()
         return render_template('gestion_productos.html', 
                                productos=paginated_records, search_term=search_term, 
                                current_page=page, total_pages=total_pages, endpoint='gestion_productos')
@@ -566,7 +686,6 @@ def nuevo_producto():
         product_data = [nombre, forma, presentacion]
         success, message = data_manager.add_product_presentation(product_data)
         if success:
-            data_manager.product_data = data_manager._load_product_data()
             data_manager.log_action(session.get('username'), "Añadió Presentación", f"Producto: {nombre}, Presentación: {presentacion}")
             flash(message, 'success')
             return redirect(url_for('gestion_productos'))
@@ -587,7 +706,6 @@ def eliminar_presentacion(product_name, presentation):
         p_presentation = unquote_plus(presentation)
         success, message = data_manager.delete_product_presentation(p_name, p_presentation)
         if success:
-            data_manager.product_data = data_manager._load_product_data()
             data_manager.log_action(session.get('username'), "Eliminó Presentación", f"Producto: {p_name}, Presentación: {p_presentation}")
             flash(message, 'success')
         else:
@@ -596,6 +714,14 @@ def eliminar_presentacion(product_name, presentation):
         flash(f"Error en el servidor al intentar eliminar: {e}", "danger")
     return redirect(url_for('gestion_productos'))
 
+@app.route('/api/estado-cuota')
+@admin_required
+def estado_cuota():
+    """Margen de cuota de Google Sheets del worker que atiende la petición."""
+    if not data_manager:
+        return jsonify({'success': False, 'message': 'Gestor de datos no disponible'}), 500
+    return jsonify({'success': True, 'cuotas': data_manager.quota_headroom()})
+
 @app.route('/log-actividad')
 @admin_required
 def log_actividad():
@@ -607,8 +733,7 @@ def log_actividad():
 def generate_pdf(codigo, pdf_type):
     if 'username' not in session: 
         return redirect(url_for('login'))
-    all_records = data_manager.get_all_records()
-    record_to_print = next((r for r in all_records if r.get('CODIGO') == codigo), None)
+    _, record_to_print = data_manager.get_record_by_codigo(codigo)
     if record_to_print:
         pdf_bytes = generar_certificado_en_memoria(record_to_print, pdf_class_name=pdf_type)
         if pdf_bytes:
@@ -635,7 +760,8 @@ def nuevo_registro():
             datos_formulario = {key: request.form.get(key, '') for key in get_column_order()}
             for key in ['FECHA_PRODUCCION', 'FECHA_VENCIMIENTO', 'FECHA_ANALISIS', 'FECHA_EMISION']:
                 datos_formulario[key] = format_date_for_sheet(request.form.get(key))
-            datos_formulario['CODIGO'] = data_manager.get_next_codigo()
+            # Se reserva el código en la secuencia local: dos altas simultáneas nunca reciben el mismo.
+            datos_formulario['CODIGO'] = data_manager.allocate_codigo()
             datos_formulario['FECHA_DE_REGISTRO'] = datetime.now().strftime("%d-%m-%Y %H:%M:%S")
             datos_formulario['CREADO_POR'] = session.get('username', 'desconocido')
             datos_formulario['CANTIDAD'] = f"{request.form.get('CANTIDAD', '0')} {request.form.get('UNIDAD_CANTIDAD', 'KG')}"
@@ -658,8 +784,7 @@ def nuevo_registro():
         return render_template(
             'formulario_registro.html', is_edit_mode=False, record_data={},
             product_list=sorted(list(data_manager.product_data.keys())),
-            product_data_json=json.dumps(data_manager.product_data),
-            specs_data_json=json.dumps(data_manager.specs_data),
+            product_data_json=data_manager.get_product_data_json(),
             next_code=data_manager.get_next_codigo()
         )
 
@@ -667,12 +792,9 @@ def nuevo_registro():
 def editar_registro(codigo):
     if 'username' not in session: return redirect(url_for('login'))
     
-    all_records = data_manager.get_all_records()
-    record_to_edit, original_index = None, -1
-    for i, record in enumerate(all_records):
-        if str(record.get('CODIGO')) == str(codigo):
-            record_to_edit, original_index = record, i
-            break
+    # Al guardar se relee la fila del certificado para no sobrescribir cambios recientes
+    # con una copia en caché; para mostrar el formulario basta con el índice en memoria.
+    sheet_row, record_to_edit = data_manager.get_record_by_codigo(codigo, fresh=request.method == 'POST')
 
     if not record_to_edit:
         flash(f'No se encontró el registro {codigo}.', 'danger')
@@ -742,7 +864,7 @@ def editar_registro(codigo):
                         print(f"  {nota_key} (pos {idx}): {lista_ordenada[idx]}")
             print("")
             
-            data_manager.update_record(original_index + 2, lista_ordenada)
+            data_manager.update_record(sheet_row, lista_ordenada)
             flash('¡Registro actualizado con éxito!', 'success')
             data_manager.log_action(session.get('username'), "Editó Certificado", f"Código: {codigo}")
             return redirect(url_for('registros'))
@@ -751,12 +873,142 @@ def editar_registro(codigo):
             return redirect(url_for('editar_registro', codigo=codigo))
     else: # GET
         return render_template(
-            'formulario_registro.html', is_edit_mode=True, record_data=record_to_edit,
+            'formulario_registro.html', is_edit_mode=True, record_data=record_to_edit.copy(),
             product_list=sorted(list(data_manager.product_data.keys())),
-            product_data_json=json.dumps(data_manager.product_data),
-            specs_data_json=json.dumps(data_manager.specs_data)
+            product_data_json=data_manager.get_product_data_json()
         )
 
+@app.route('/api/especificaciones')
+@api_login_required()
+def especificaciones_producto():
+    """Especificaciones de un producto (y opcionalmente una versión) para el formulario de registro."""
+    if not data_manager:
+        return jsonify({'success': False, 'message': 'Gestor de datos no disponible'}), 500
+    producto = request.args.get('producto', '')
+    version = request.args.get('version') or None
+    if not producto:
+        return jsonify({'success': False, 'message': 'Debe indicar un producto'}), 400
+    # Se serializa con json.dumps para conservar el orden de las versiones de la hoja
+    # (jsonify ordena las claves alfabéticamente).
+    payload = json.dumps({'producto': producto, 'versiones': data_manager.get_specs(producto, version)})
+    return app.response_class(payload, mimetype='application/json')
+
+# Columnas que devuelve /api/registros si no se indica fields=.
+API_DEFAULT_FIELDS = ['CODIGO', 'PRODUCTO', 'LOTE', 'CONCLUSION', 'FECHA_DE_REGISTRO']
+API_MAX_LIMIT = 500
+
+def encode_cursor(key):
+    """Cursor opaco a partir de (fecha de registro ISO, fila) del último certificado de una página."""
+    return base64.urlsafe_b64encode(json.dumps(key).encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+    """Devuelve (fecha de registro ISO, fila) de un cursor; ValueError si no es válido."""
+    try:
+        fecha, sheet_row = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        datetime.fromisoformat(fecha)
+        return fecha, int(sheet_row)
+    except Exception as e:
+        raise ValueError(f"Cursor inválido: {cursor}") from e
+
+@app.route('/api/registros')
+@limiter.limit("600 per hour")
+@api_login_required()
+def api_registros():
+    """
+    Certificados en JSON para integraciones (ERP, LIMS), del más reciente al más antiguo.
+
+    Acepta los mismos filtros que el listado (search, fecha_inicio, fecha_fin) y producto;
+    fields= con las columnas separadas por comas ('all' para todas); limit= (hasta
+    API_MAX_LIMIT) y cursor=, el valor 'siguiente' de la página anterior. Cada página
+    continúa justo después del último certificado devuelto, así que pedir la página
+    cien cuesta lo mismo que la primera.
+
+    Además de la sesión del navegador admite una clave de API (ver API_KEYS) en la
+    cabecera 'Authorization: Bearer <clave>'.
+    """
+    if not data_manager:
+        return jsonify({'success': False, 'message': 'Gestor de datos no disponible'}), 500
+
+    columns = get_column_order()
+    fields_arg = request.args.get('fields', '').strip()
+    if fields_arg == 'all':
+        fields = columns
+    elif fields_arg:
+        fields = [f.strip() for f in fields_arg.split(',') if f.strip()]
+    else:
+        fields = API_DEFAULT_FIELDS
+    unknown = [f for f in fields if f not in columns]
+    if unknown:
+        return jsonify({'success': False, 'message': f"Campos desconocidos: {', '.join(unknown)}"}), 400
+
+    after = None
+    if request.args.get('cursor'):
+        try:
+            after = decode_cursor(request.args['cursor'])
+        except ValueError as e:
+            return jsonify({'success': False, 'message': str(e)}), 400
+    limit = min(max(request.args.get('limit', 100, type=int), 1), API_MAX_LIMIT)
+
+    # Se pide un certificado más de los necesarios para saber si hay otra página sin contar el total.
+    rows = data_manager.query_records_after(
+        search_term=request.args.get('search', '').lower(),
+        fecha_inicio=parse_filter_date(request.args.get('fecha_inicio', '')),
+        fecha_fin=parse_filter_date(request.args.get('fecha_fin', '')),
+        producto=request.args.get('producto') or None,
+        after=after,
+        limit=limit + 1
+    )
+    page = rows[:limit]
+    # json.dumps conserva el orden de fields (jsonify ordena las claves alfabéticamente).
+    payload = json.dumps({
+        'success': True,
+        'registros': [{f: record.get(f, '') for f in fields} for _, record in page],
+        'siguiente': encode_cursor(page[-1][0]) if len(rows) > limit else None,
+    }, ensure_ascii=False)
+    return app.response_class(payload, mimetype='application/json')
+
+@app.route('/api/dashboard/series')
+@limiter.limit("600 per hour")
+def api_dashboard_series():
+    """
+    Evolución de aprobados, rechazados y pendientes para los gráficos de tendencia.
+
+    granularidad= dia, semana, mes (por defecto) o trimestre; fecha_inicio, fecha_fin y
+    producto como en el dashboard. El rango puede abarcar varios años: se parte de los
+    recuentos diarios del backend y se agrupan en el servidor, así que al navegador solo
+    llegan los periodos. Cada combinación de filtros se guarda en
+    ajax_cache hasta que cambien los certificados. Si la serie tendría más de
+    SERIES_MAX_PERIODS periodos se responde 400.
+    """
+    if 'username' not in session:
+        return jsonify({'success': False, 'message': 'No autorizado'}), 401
+    if not data_manager:
+        return jsonify({'success': False, 'message': 'Gestor de datos no disponible'}), 500
+
+    granularidad = request.args.get('granularidad', 'mes')
+    if granularidad not in SERIES_GRANULARITIES:
+        return jsonify({'success': False, 'message': f"Granularidad no válida: {granularidad}"}), 400
+    producto = request.args.get('producto') or None
+    fecha_inicio = parse_filter_date(request.args.get('fecha_inicio', ''))
+    fecha_fin = parse_filter_date(request.args.get('fecha_fin', ''))
+    too_many_periods = f"El rango supera el máximo de {SERIES_MAX_PERIODS} periodos; elija una granularidad mayor"
+    # Con las dos fechas se comprueba antes de consultar; si falta alguna, el rango
+    # depende de los datos y lo comprueba resample_counts.
+    if fecha_inicio and fecha_fin and count_periods(granularidad, fecha_inicio, fecha_fin) > SERIES_MAX_PERIODS:
+        return jsonify({'success': False, 'message': too_many_periods}), 400
+
+    def render_payload():
+        counts = data_manager.summary_counts(producto, fecha_inicio, fecha_fin)
+        return {'success': True, 'granularidad': granularidad,
+                'series': resample_counts(counts, granularidad, fecha_inicio, fecha_fin)}
+
+    cache_key = ('series', producto, granularidad, fecha_inicio, fecha_fin,
+                 data_manager.records_version)
+    try:
+        return cached_ajax_response(cache_key, render_payload)
+    except TooManyPeriods:
+        return jsonify({'success': False, 'message': too_many_periods}), 400
+
 @app.cli.command("sync-headers")
 def sync_headers_command():
     """Sincroniza los encabezados de Google Sheets con las columnas esperadas (incluye NOTA1-NOTA20)."""
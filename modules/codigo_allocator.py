@@ -0,0 +1,89 @@
+import os
+import sqlite3
+import threading
+from datetime import datetime
+
+# Conexiones abiertas antes de un fork; se conservan para que el recolector no las cierre en el hijo.
+_inherited_connections = []
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS secuencia_codigos (
+    anio TEXT PRIMARY KEY,
+    ultimo INTEGER NOT NULL
+);
+"""
+
+
+def parse_codigo(codigo):
+    """Separa un CODIGO 'NNNN-AAAA' en (numero, anio). Devuelve None si no tiene ese formato."""
+    parts = str(codigo or '').split('-')
+    if len(parts) != 2 or not parts[0].isdigit() or not parts[1].isdigit():
+        return None
+    return int(parts[0]), parts[1]
+
+
+class CodigoAllocator:
+    """
+    Asigna los códigos correlativos de certificados (NNNN-AAAA) desde una secuencia en SQLite.
+
+    La secuencia se inicializa una vez con los códigos que ya existen en la hoja y a
+    partir de ahí cada asignación es una transacción local (BEGIN IMMEDIATE), por lo que
+    dos workers de gunicorn nunca obtienen el mismo número. Al cambiar de año la
+    numeración vuelve a empezar en 0001.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.executescript(SCHEMA)
+
+    def _connection(self):
+        # Una conexión por hilo y por proceso: tras un fork (gunicorn --preload) el hijo no
+        # debe usar la que abrió el maestro.
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            if conn is not None:
+                # La heredada no se cierra desde el hijo (SQLite lo desaconseja): solo se deja de usar.
+                _inherited_connections.append(conn)
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def seed(self, codigos):
+        """Ajusta la secuencia para que nunca quede por debajo de los códigos existentes."""
+        maximos = {}
+        for codigo in codigos:
+            parsed = parse_codigo(codigo)
+            if parsed:
+                numero, anio = parsed
+                maximos[anio] = max(numero, maximos.get(anio, 0))
+        with self._connection() as conn:
+            for anio, numero in maximos.items():
+                conn.execute(
+                    'INSERT INTO secuencia_codigos (anio, ultimo) VALUES (?, ?) '
+                    'ON CONFLICT(anio) DO UPDATE SET ultimo = MAX(ultimo, excluded.ultimo)',
+                    (anio, numero)
+                )
+
+    def peek(self):
+        """Código que recibiría la próxima alta, sin reservarlo (para mostrarlo en el formulario)."""
+        anio = str(datetime.now().year)
+        row = self._connection().execute('SELECT ultimo FROM secuencia_codigos WHERE anio = ?', (anio,)).fetchone()
+        return f"{(row[0] if row else 0) + 1:04d}-{anio}"
+
+    def allocate(self):
+        """Reserva y devuelve el siguiente código del año en curso."""
+        anio = str(datetime.now().year)
+        conn = self._connection()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute(
+                'INSERT INTO secuencia_codigos (anio, ultimo) VALUES (?, 1) '
+                'ON CONFLICT(anio) DO UPDATE SET ultimo = ultimo + 1',
+                (anio,)
+            )
+            numero = conn.execute('SELECT ultimo FROM secuencia_codigos WHERE anio = ?', (anio,)).fetchone()[0]
+        return f"{numero:04d}-{anio}"
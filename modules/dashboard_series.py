@@ -0,0 +1,56 @@
+import pandas as pd
+
+# Granularidades de resample_counts -> periodo de pandas. Las semanas van de lunes a
+# domingo ('W-SUN': la semana que termina en domingo) y cada periodo se identifica por
+# su primer día.
+SERIES_GRANULARITIES = {'dia': 'D', 'semana': 'W-SUN', 'mes': 'M', 'trimestre': 'Q'}
+SERIES_CONCLUSIONS = ['APROBADO', 'RECHAZADO', 'PENDIENTE']
+# Máximo de periodos de una serie (p. ej. unos tres años día a día).
+SERIES_MAX_PERIODS = 1100
+
+
+class TooManyPeriods(ValueError):
+    """La serie pedida tendría más de SERIES_MAX_PERIODS periodos."""
+
+
+def count_periods(granularity, fecha_inicio, fecha_fin):
+    """Número de periodos de `granularity` entre fecha_inicio y fecha_fin (inclusive)."""
+    if fecha_fin < fecha_inicio:
+        return 0
+    freq = SERIES_GRANULARITIES[granularity]
+    return pd.Period(fecha_fin, freq).ordinal - pd.Period(fecha_inicio, freq).ordinal + 1
+
+
+def resample_counts(counts, granularity, fecha_inicio=None, fecha_fin=None):
+    """
+    Agrupa recuentos diarios ({(día, CONCLUSION): total}, como los de summary_counts)
+    en periodos de `granularity` (ver SERIES_GRANULARITIES).
+
+    Los periodos sin certificados se incluyen con cero, desde fecha_inicio (o el primer
+    día con datos) hasta fecha_fin (o el último). Los certificados sin fecha se ignoran.
+
+    Returns:
+        list: [{'periodo': 'YYYY-MM-DD', 'aprobado': n, 'rechazado': n, 'pendiente': n}, ...]
+
+    Raises:
+        TooManyPeriods: si la serie tendría más de SERIES_MAX_PERIODS periodos.
+    """
+    freq = SERIES_GRANULARITIES[granularity]
+    rows = [(day, conclusion, total) for (day, conclusion), total in counts.items() if day is not None]
+    if not rows and not (fecha_inicio and fecha_fin):
+        return []
+    start = fecha_inicio or min(day for day, _, _ in rows)
+    end = fecha_fin or max(day for day, _, _ in rows)
+    if count_periods(granularity, start, end) > SERIES_MAX_PERIODS:
+        raise TooManyPeriods(f"La serie supera el máximo de {SERIES_MAX_PERIODS} periodos")
+    daily = pd.DataFrame(rows, columns=['dia', 'conclusion', 'total'])
+    daily = (daily.pivot_table(index='dia', columns='conclusion', values='total', aggfunc='sum', fill_value=0)
+             .reindex(columns=SERIES_CONCLUSIONS, fill_value=0))
+    daily.index = pd.to_datetime(daily.index)
+    daily = daily.reindex(pd.date_range(start, end, freq='D'), fill_value=0)
+    periods = daily.groupby(daily.index.to_period(freq)).sum()
+    return [
+        {'periodo': periodo.start_time.strftime('%Y-%m-%d'),
+         **{conclusion.lower(): int(row[conclusion]) for conclusion in SERIES_CONCLUSIONS}}
+        for periodo, row in periods.iterrows()
+    ]
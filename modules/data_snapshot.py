@@ -0,0 +1,59 @@
+import os
+import pickle
+import tempfile
+import time
+
+# Se incrementa cuando cambia la estructura de lo que se guarda; las copias con otro
+# formato se ignoran y el worker arranca leyendo Google Sheets como siempre.
+SNAPSHOT_FORMAT = 2
+
+
+class DataSnapshot:
+    """
+    Copia local (pickle) de los datos en memoria de GoogleSheetManager.
+
+    Cada sección ('referencias', 'certificados') se guarda en su propio archivo tras
+    cada recarga correcta, de modo que un worker nuevo pueda restaurarla en milisegundos
+    y servir peticiones mientras revalida contra Google Sheets en segundo plano. La
+    escritura es atómica (archivo temporal único + os.replace), así que varios workers e
+    hilos pueden guardar a la vez sin que nadie lea un archivo a medias.
+
+    Los archivos se crean con permisos 0600 (solo el usuario del proceso). Aun así no se
+    guarda nada sensible: el directorio de usuarios, con los hashes de contraseña, no
+    forma parte de la copia.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, section):
+        return os.path.join(self.directory, f"{section}.pickle")
+
+    def save(self, section, data):
+        path = self._path(section)
+        payload = {'formato': SNAPSHOT_FORMAT, 'guardado_en': time.time(), 'datos': data}
+        # mkstemp da un nombre distinto a cada escritura (aunque sean dos hilos del mismo
+        # proceso) y crea el archivo con permisos 0600.
+        fd, tmp_path = tempfile.mkstemp(prefix=f"{section}.", suffix='.tmp', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(payload, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def load(self, section):
+        """Devuelve los datos guardados de la sección, o None si no hay copia válida."""
+        try:
+            with open(self._path(section), 'rb') as f:
+                payload = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"Advertencia: Copia local '{section}' ilegible; se ignora: {e}")
+            return None
+        if not isinstance(payload, dict) or payload.get('formato') != SNAPSHOT_FORMAT:
+            return None
+        return payload['datos']
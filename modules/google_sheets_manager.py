@@ -2,41 +2,103 @@ import gspread
 from google.oauth2.service_account import Credentials
 from datetime import datetime
 import os
-import sys
 import json
+import threading
+import time
+from modules.sqlite_replica import SQLiteReplica
+from modules.write_behind_queue import WriteBehindQueue
+from modules.codigo_allocator import CodigoAllocator
+from modules.sheets_session import PooledAuthorizedSession
+from modules.sheets_governor import QuotaGovernor
+from modules.data_snapshot import DataSnapshot
+from modules.storage_backends import (
+    StorageBackend, resource_path, get_column_order, record_from_row, schema_for, build_product_data,
+    build_specs_data, filter_records, filter_records_after, summary_counts, RecordDateIndex, SQLITE_DB_PATH, USER_COLUMNS, PRODUCT_COLUMNS,
+    RECORDS_SHEET
+)
 # from supabase import create_client, Client # ELIMINADO SUPABASE
 
-def resource_path(relative_path):
-    try:
-        base_path = sys._MEIPASS
-    except Exception:
-        base_path = os.path.abspath(".")
-    return os.path.join(base_path, relative_path)
-
-def get_column_order():
-    cols = ['CODIGO','PRODUCTO','PRESENTACION','LOTE',
-            'VERSION_ESPECIFICACION',
-            'FORMA_FARMACEUTICA','CANTIDAD',
-            'FECHA_PRODUCCION','FECHA_VENCIMIENTO','FECHA_ANALISIS','FECHA_EMISION',
-            'LABORATORIO','REFERENCIA','FECHA_DE_REGISTRO','CONCLUSION',
-            'OBSERVACIONES','CREADO_POR']
-    for i in range(1, 21): 
-        cols.extend([f'ENSAYO{i}', f'ESPECIFICACION{i}', f'RESULTADO{i}'])
-    for i in range(1, 21):
-        cols.append(f'NOTA{i}')
-    
-    # Debug: Imprimir posición de las NOTAS
-    if False:  # Cambiar a True para debug
-        print("DEBUG - Posiciones de columnas NOTA:")
-        for i in range(1, 21):
-            nota_key = f'NOTA{i}'
-            if nota_key in cols:
-                print(f"  {nota_key}: posición {cols.index(nota_key)}")
-    
-    return cols
+# Tiempo de vida (en segundos) de la caché en memoria de los certificados.
+# Las escrituras propias (add_record/update_record) se aplican directamente sobre
+# la caché, así que el TTL solo limita cuánto tardan en verse cambios hechos
+# directamente en la hoja por otras personas o procesos.
+RECORDS_CACHE_TTL = int(os.getenv('RECORDS_CACHE_TTL', '60'))
+
+# Cada cuántos segundos se fuerza una relectura completa de la hoja de certificados.
+# Entre recargas completas solo se descargan las filas añadidas al final de la hoja.
+RECORDS_FULL_REFRESH_INTERVAL = int(os.getenv('RECORDS_FULL_REFRESH_INTERVAL', '900'))
+
+# Tiempo de vida (en segundos) del directorio de usuarios en memoria. Las altas, bajas
+# y cambios hechos desde la aplicación se aplican directamente sobre el directorio.
+USERS_CACHE_TTL = int(os.getenv('USERS_CACHE_TTL', '300'))
+
+# Antigüedad máxima (en segundos) del catálogo de productos con la que se valida un alta
+# o una baja de presentación; si es más viejo, se relee la hoja Productos antes.
+PRODUCTS_CACHE_TTL = int(os.getenv('PRODUCTS_CACHE_TTL', '300'))
+
+# Réplica local en SQLite de las hojas (en SQLITE_DB_PATH). Las lecturas de listados,
+# dashboard y certificados individuales se resuelven contra ella en lugar de contra la API.
+USE_SQLITE_REPLICA = os.getenv('USE_SQLITE_REPLICA', 'true').lower() in ('1', 'true', 'yes')
+
+# Cola de escrituras diferidas: las altas y modificaciones se guardan en un diario local
+# y se envían a Google Sheets agrupadas cada WRITE_BEHIND_INTERVAL segundos (o al juntar
+# WRITE_BEHIND_BATCH_SIZE escrituras), fuera del hilo de la petición.
+SHEETS_WRITE_BEHIND = os.getenv('SHEETS_WRITE_BEHIND', 'true').lower() in ('1', 'true', 'yes')
+WRITE_BEHIND_INTERVAL = float(os.getenv('WRITE_BEHIND_INTERVAL', '1.0'))
+WRITE_BEHIND_BATCH_SIZE = int(os.getenv('WRITE_BEHIND_BATCH_SIZE', '50'))
+
+# Conexiones keep-alive que se mantienen abiertas hacia la API de Google Sheets y
+# segundos de antelación con que se renueva el token de la cuenta de servicio.
+SHEETS_HTTP_POOL_SIZE = int(os.getenv('SHEETS_HTTP_POOL_SIZE', '10'))
+SHEETS_TOKEN_REFRESH_MARGIN = int(os.getenv('SHEETS_TOKEN_REFRESH_MARGIN', '300'))
+
+# Cuotas de la API por minuto (por proceso: con varios workers de gunicorn conviene
+# repartir la cuota del proyecto entre ellos). Las llamadas esperan turno antes de
+# superarlas y los 429 (y en lecturas también 500/503) se reintentan con espera exponencial.
+SHEETS_READ_QUOTA_PER_MINUTE = int(os.getenv('SHEETS_READ_QUOTA_PER_MINUTE', '60'))
+SHEETS_WRITE_QUOTA_PER_MINUTE = int(os.getenv('SHEETS_WRITE_QUOTA_PER_MINUTE', '60'))
+SHEETS_QUOTA_BURST = int(os.getenv('SHEETS_QUOTA_BURST', '10'))
+SHEETS_MAX_RETRIES = int(os.getenv('SHEETS_MAX_RETRIES', '5'))
+SHEETS_QUOTA_MAX_WAIT = float(os.getenv('SHEETS_QUOTA_MAX_WAIT', '60'))
+
+# Copia local de los datos en memoria: un worker nuevo la restaura al arrancar y atiende
+# enseguida mientras revalida contra Google Sheets en segundo plano.
+USE_DATA_SNAPSHOT = os.getenv('USE_DATA_SNAPSHOT', 'true').lower() in ('1', 'true', 'yes')
+DATA_SNAPSHOT_DIR = os.getenv('DATA_SNAPSHOT_DIR', resource_path('snapshot'))
 
-class GoogleSheetManager:
+# Hojas de referencia que se cargan juntas en un solo values:batchGet.
+REFERENCE_SHEETS = ("Productos", "Maestro Especificaciones", "Usuarios")
+
+
+def quote_sheet_title(title):
+    """Nombre de hoja listo para usarse en notación A1 ('Mi hoja', con comillas escapadas)."""
+    return "'{}'".format(title.replace("'", "''"))
+
+
+def records_from_values(values):
+    """
+    Convierte los valores de un rango (fila 1 = encabezados) en diccionarios, igual que
+    Worksheet.get_all_records: filas completadas con '' y números convertidos.
+    """
+    if not values:
+        return []
+    headers = values[0]
+    return [
+        dict(zip(headers, gspread.utils.numericise_all(list(row) + [''] * (len(headers) - len(row)))))
+        for row in values[1:]
+    ]
+
+class GoogleSheetManager(StorageBackend):
     def __init__(self):
+        super().__init__()
+        self.governor = QuotaGovernor(
+            {'lectura': SHEETS_READ_QUOTA_PER_MINUTE, 'escritura': SHEETS_WRITE_QUOTA_PER_MINUTE},
+            burst=SHEETS_QUOTA_BURST, max_retries=SHEETS_MAX_RETRIES, max_wait=SHEETS_QUOTA_MAX_WAIT
+        )
+        # Handles de las hojas por título (ver _worksheet).
+        self._worksheets = {}
+        self._worksheets_lock = threading.Lock()
+
         # --- CONEXIÓN A GOOGLE SHEETS ---
         try:
             scopes = ['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive']
@@ -54,14 +116,22 @@ class GoogleSheetManager:
                 creds_path = os.path.join(os.path.abspath("."), 'credentials.json')
                 creds = Credentials.from_service_account_file(creds_path, scopes=scopes)
 
-            self.client = gspread.authorize(creds)
+            # Todas las llamadas de gspread comparten una sesión con conexiones reutilizables
+            # y pasan por el regulador de cuota.
+            self.session = PooledAuthorizedSession(creds, pool_size=SHEETS_HTTP_POOL_SIZE,
+                                                   refresh_margin=SHEETS_TOKEN_REFRESH_MARGIN,
+                                                   governor=self.governor)
+            self.client = gspread.Client(creds, session=self.session)
             self.spreadsheet = self.client.open('CertificadosDeAnalisis')
-            self.worksheet = self.spreadsheet.sheet1
+            # Se resuelven todas las hojas con una sola lectura de metadatos; después
+            # _worksheet() las sirve desde memoria sin volver a consultarlos.
+            self.worksheet = self._load_worksheets()[0]
             print("Conexión con Google Sheets establecida.")
         except Exception as e:
             print(f"ERROR CRÍTICO al inicializar GoogleSheetManager: {e}")
             # --- INICIO DE LA CORRECCIÓN ---
             # No relanzar la excepción para permitir que la app inicie incluso si Sheets falla.
+            self.session = None
             self.client = None
             self.spreadsheet = None
             self.worksheet = None
@@ -74,8 +144,87 @@ class GoogleSheetManager:
         # --- Carga de datos inicial (Lazy) ---
         self._product_data = None
         self._specs_data = None
+        # --- Catálogo de productos indexado ---
+        # _product_records: filas de la hoja Productos en orden (fila en la hoja = posición + 2).
+        # _product_rows: (PRODUCTO, PRESENTACION) -> fila en la hoja, para que añadir o eliminar
+        # una presentación no tenga que volver a leer la hoja completa.
+        self._product_records = []
+        self._product_rows = {}
+        self._products_flat = []
+        self._unique_presentations = []
+        self._product_data_json = None
+        # Se incrementa cada vez que se reconstruye el catálogo (ver _rebuild_product_views).
+        self._products_version = 0
+        # Momento de la última lectura de Productos desde la hoja (la copia local no cuenta).
+        self._products_loaded_at = 0.0
+        self._products_lock = threading.RLock()
         # Quitamos la carga automática de __init__ para acelerar el arranque en Render
 
+        # --- Caché de registros (write-through) ---
+        # _records_version se incrementa en cada recarga y en cada escritura propia,
+        # de modo que cualquier estructura derivada puede saber si quedó obsoleta.
+        self._records_cache = None
+        self._records_headers = None
+        # Índice CODIGO -> (fila en la hoja, registro). Como los certificados solo se
+        # añaden al final, las filas ya indexadas no cambian al agregar otros nuevos.
+        self._codigo_index = {}
+        # Fechas de registro ya convertidas y ordenadas, para filtrar la caché sin réplica.
+        self._records_date_index = None
+        # Altas de este proceso que siguen en la cola de escritura: CODIGO -> registro.
+        # Su fila en la hoja se conoce al enviarlas (ver _on_append_flushed); hasta entonces
+        # no están en la caché, el índice por CODIGO ni la réplica.
+        self._pending_records = {}
+        self._records_loaded_at = 0.0
+        self._records_full_loaded_at = 0.0
+        self._records_version = 0
+        self._records_lock = threading.RLock()
+
+        # --- Directorio de usuarios ---
+        # _users_index: USERNAME en minúsculas -> (fila en la hoja, usuario).
+        self._users_cache = None
+        self._users_index = {}
+        self._users_loaded_at = 0.0
+        self._users_lock = threading.RLock()
+
+        # --- Réplica local en SQLite ---
+        self.replica = None
+        if USE_SQLITE_REPLICA:
+            try:
+                self.replica = SQLiteReplica(SQLITE_DB_PATH)
+            except Exception as e:
+                print(f"Advertencia: No se pudo abrir la réplica SQLite en {SQLITE_DB_PATH}: {e}")
+
+        # --- Secuencia de códigos de certificado ---
+        # Se inicializa con los códigos existentes la primera vez que se necesita.
+        self.codigo_allocator = None
+        self._codigo_allocator_seeded = False
+        if self.spreadsheet:
+            try:
+                self.codigo_allocator = CodigoAllocator(SQLITE_DB_PATH)
+            except Exception as e:
+                print(f"Advertencia: No se pudo abrir la secuencia de códigos; se calculará desde la hoja: {e}")
+
+        # --- Copia local de los datos ---
+        self.snapshot = None
+        if USE_DATA_SNAPSHOT and self.spreadsheet:
+            try:
+                self.snapshot = DataSnapshot(DATA_SNAPSHOT_DIR)
+            except Exception as e:
+                print(f"Advertencia: No se pudo abrir la copia local en {DATA_SNAPSHOT_DIR}: {e}")
+
+        # --- Cola de escrituras diferidas ---
+        # Se crea al final porque puede empezar a enviar escrituras pendientes de una
+        # ejecución anterior y para eso usa los índices de arriba.
+        self.write_queue = None
+        if SHEETS_WRITE_BEHIND and self.spreadsheet:
+            try:
+                self.write_queue = WriteBehindQueue(
+                    SQLITE_DB_PATH, self._resolve_worksheet, self._on_append_flushed,
+                    flush_interval=WRITE_BEHIND_INTERVAL, batch_size=WRITE_BEHIND_BATCH_SIZE
+                )
+            except Exception as e:
+                print(f"Advertencia: No se pudo abrir el diario de escrituras; se escribirá directamente en Sheets: {e}")
+
     @property
     def product_data(self):
         self._ensure_data_loaded()
@@ -86,17 +235,201 @@ class GoogleSheetManager:
         self._ensure_data_loaded()
         return self._specs_data
     
+    @property
+    def products_version(self):
+        self._ensure_data_loaded()
+        return self._products_version
+
     def _ensure_data_loaded(self):
         """Asegura que los datos estén cargados antes de ser usados."""
         if self.spreadsheet and (self._product_data is None or self._specs_data is None):
             print("Cargando datos de Google Sheets (Lazy Load)...")
             try:
-                self._product_data = self._load_product_data()
-                self._specs_data = self._load_specs_data()
+                self._load_reference_data()
             except Exception as e:
                 print(f"Error en Lazy Load: {e}")
-                self._product_data, self._specs_data = {}, {}
+                self._load_reference_from_replica()
+
+    def _warm_up_tasks(self):
+        """Las hojas de referencia (una sola llamada) y los certificados se leen a la vez."""
+        if not self.spreadsheet:
+            return {}
+        return {
+            'referencias': self._load_reference_data,
+            'certificados': self._warm_up_records,
+        }
+
+    def _warm_up_records(self):
+        # Siempre se relee la hoja completa: si se restauró la copia local, esto la revalida
+        # sin bloquear a las lecturas (el candado solo se toma para reemplazar la caché).
+        self._full_refresh_records()
+        if self.codigo_allocator:
+            self._ensure_codigo_allocator_seeded()
+
+    def _restore_snapshot(self):
+        """Carga la copia local de referencias y certificados; True si se restauraron ambas."""
+        if not self.snapshot:
+            return False
+        started = time.monotonic()
+        referencias = self.snapshot.load('referencias')
+        certificados = self.snapshot.load('certificados')
+        if referencias:
+            # Los usuarios no se guardan en la copia (ver DataSnapshot); se leen al primer acceso.
+            self._set_product_records(referencias['productos'])
+            self._specs_data = referencias['especificaciones']
+        if certificados:
+            with self._records_lock:
+                self._set_records_cache(certificados['encabezados'], certificados['registros'])
+        if referencias or certificados:
+            print(f"Copia local de datos restaurada en {(time.monotonic() - started) * 1000:.0f} ms.")
+        return bool(referencias and certificados)
+
+    def _save_snapshot(self, section, data):
+        """Guarda una sección de la copia local en segundo plano, sin retrasar la petición."""
+        if not self.snapshot:
+            return
+        def save():
+            try:
+                self.snapshot.save(section, data)
+            except Exception as e:
+                print(f"Advertencia: No se pudo guardar la copia local '{section}': {e}")
+        threading.Thread(target=save, name=f'snapshot-{section}', daemon=True).start()
+
+    def _save_records_snapshot(self):
+        with self._records_lock:
+            if self._records_cache is None:
+                return
+            data = {'encabezados': self._records_headers, 'registros': list(self._records_cache)}
+        self._save_snapshot('certificados', data)
+
+    def _load_reference_from_replica(self):
+        """Reconstruye productos y especificaciones desde la réplica si Google Sheets no responde."""
+        product_records, specs_data = [], {}
+        if self.replica:
+            try:
+                print("Usando la réplica local de productos y especificaciones.")
+                product_records = self.replica.get_reference("Productos")
+                specs_data = build_specs_data(self.replica.get_reference("Maestro Especificaciones"))
+            except Exception as e:
+                print(f"Error al leer la réplica local: {e}")
+        self._set_product_records(product_records)
+        self._specs_data = specs_data
+
+    def _load_worksheets(self):
+        """Lee una vez los metadatos de la hoja de cálculo y guarda el handle de cada hoja."""
+        worksheets = self.spreadsheet.worksheets()
+        with self._worksheets_lock:
+            self._worksheets = {ws.title: ws for ws in worksheets}
+        return worksheets
+
+    def _worksheet(self, title):
+        """
+        Handle de la hoja `title` sin consultar metadatos en cada llamada.
+
+        Si el título no está en memoria (hoja creada o renombrada después de cargarla) se
+        vuelven a leer los metadatos una vez antes de lanzar WorksheetNotFound.
+        """
+        worksheet = self._worksheets.get(title)
+        if worksheet is None:
+            self._load_worksheets()
+            worksheet = self._worksheets.get(title)
+            if worksheet is None:
+                raise gspread.exceptions.WorksheetNotFound(title)
+        return worksheet
+
+    def _forget_worksheet(self, title):
+        """Descarta el handle de una hoja tras un error, por si se borró o renombró."""
+        with self._worksheets_lock:
+            self._worksheets.pop(title, None)
+
+    def _resolve_worksheet(self, title):
+        if self.worksheet and title == self.worksheet.title:
+            return self.worksheet
+        return self._worksheet(title)
+
+    def _on_append_flushed(self, sheet_title, key, sheet_row, values):
+        """
+        La cola confirmó un alta en `sheet_row`. Los certificados solo pasan a la caché,
+        al índice por CODIGO y a la réplica compartida en este momento, con su fila real.
+        """
+        if self.worksheet and sheet_title == self.worksheet.title:
+            record = record_from_row(values)
+            with self._records_lock:
+                if sheet_row is None:
+                    self._pending_records.pop(key, None)
+                    self._records_cache = None
+                else:
+                    if self._records_cache is not None and sheet_row == len(self._records_cache) + 2:
+                        self._records_cache.append(record)
+                        self._records_date_index.append(record)
+                    else:
+                        # Hay filas de otros procesos por medio: la próxima lectura las trae
+                        # junto con esta (ver _incremental_refresh_records).
+                        self._records_loaded_at = 0.0
+                    self._index_records(sheet_row, [record], replace=True)
+                self._records_version += 1
+            if sheet_row is not None:
+                self._replicate('upsert_records', sheet_row, [record])
+        elif sheet_title == "Usuarios":
+            with self._users_lock:
+                entry = self._users_index.get(key)
+                if sheet_row is None or entry is None or entry[0] != sheet_row:
+                    self._users_cache = None
+
+    def _pending_writes(self, sheet_title):
+        """Escrituras de la hoja que siguen en la cola ([] sin cola o si no se puede leer el diario)."""
+        if not self.write_queue:
+            return []
+        try:
+            return self.write_queue.pending(sheet_title)
+        except Exception as e:
+            print(f"Advertencia: No se pudo leer el diario de escrituras: {e}")
+            return []
+
+    def _with_pending_writes(self, sheet_title, items, to_item, key_of, earlier=(), appends=True, columns=()):
+        """
+        Aplica sobre una lectura de la hoja las escrituras que siguen esperando en la cola.
+
+        `earlier` son las que estaban en la cola antes de empezar la lectura: si se
+        confirmaron mientras se leía, la lectura puede no incluirlas y ya no están en el
+        diario, así que también se aplican (las altas no se duplican gracias a la clave).
+        Con appends=False solo se aplican las modificaciones, que ya tienen su fila.
+        Las modificaciones que no empiezan en la columna A solo cambian esas celdas del
+        elemento; `columns` da el nombre de cada columna de la hoja.
+        """
+        pending = list(earlier) + self._pending_writes(sheet_title)
+        if not appends:
+            pending = [op for op in pending if op['operacion'] != 'append']
+        if not pending:
+            return items
+        items = list(items)
+        keys = {key_of(item) for item in items}
+        for op in pending:
+            if op['operacion'] == 'append':
+                # Puede que el alta ya esté en la hoja y solo falte borrarla del diario.
+                if op['clave'] not in keys:
+                    items.append(to_item(op['valores']))
+                    keys.add(op['clave'])
+            elif 0 <= op['fila'] - 2 < len(items):
+                if op.get('columna', 1) > 1:
+                    changed = dict(zip(columns[op['columna'] - 1:], op['valores']))
+                    items[op['fila'] - 2] = {**items[op['fila'] - 2], **changed}
+                else:
+                    items[op['fila'] - 2] = to_item(op['valores'])
+        return items
+
+    def _replicate(self, method_name, *args):
+        """Aplica un cambio en la réplica SQLite sin que un fallo local afecte a la operación en Sheets."""
+        if not self.replica:
+            return
+        try:
+            getattr(self.replica, method_name)(*args)
+        except Exception as e:
+            print(f"Advertencia: No se pudo actualizar la réplica SQLite ({method_name}): {e}")
     
+    def quota_headroom(self):
+        return self.governor.headroom()
+
     # --- MÉTODOS DE LOG (DESACTIVADOS) ---
     def log_action(self, username, action, details=""):
         # Supabase desactivado. Los métodos se mantienen para evitar errores en app.py
@@ -107,134 +440,444 @@ class GoogleSheetManager:
         return []
 
     # --- MÉTODOS QUE USAN GOOGLE SHEETS ---
-    def _load_product_data(self):
-        try:
-            print("Cargando datos de productos...")
-            product_sheet = self.spreadsheet.worksheet("Productos")
-            records = product_sheet.get_all_records()
-            processed_data = {}
-            for record in records:
-                producto = record.get('PRODUCTO')
-                if not producto: continue
-                if producto not in processed_data:
-                    processed_data[producto] = {
-                        "presentaciones": [],
-                        "forma": record.get('FORMA_FARMACEUTICA', '')
-                    }
-                presentacion = record.get('PRESENTACION')
-                if presentacion:
-                    processed_data[producto]["presentaciones"].append(presentacion)
-            print("Datos de productos cargados.")
-            return processed_data
-        except Exception as e:
-            print(f"Error Crítico: No se pudieron cargar los datos de los productos: {e}")
-            raise
-    
-    def _load_specs_data(self):
-        specs_data = {}
-        try:
-            print("Cargando datos de especificaciones...")
-            specs_sheet = self.spreadsheet.worksheet("Maestro Especificaciones")
-            records = specs_sheet.get_all_records()
-            for record in records:
-                producto = record.get('PRODUCTO')
-                version = str(record.get('VER'))
-                descripcion = record.get('DESCRIPCIÓN')
-                especificacion = record.get('ESPECIFICACIÓN')
-                if not all([producto, version, descripcion, especificacion]): continue
-                if producto not in specs_data: specs_data[producto] = {}
-                if version not in specs_data[producto]: specs_data[producto][version] = []
-                specs_data[producto][version].append({"descripcion": descripcion, "especificacion": especificacion})
-            print("Datos de especificaciones cargados correctamente.")
-            return specs_data
-        except Exception as e:
-            print(f"Error al cargar especificaciones: {e}")
-            raise
+    def _load_reference_data(self):
+        """
+        Carga Productos, Maestro Especificaciones y Usuarios, más los encabezados de la hoja
+        de certificados, con una sola llamada values:batchGet, y reconstruye a partir de
+        ella el catálogo, las especificaciones y el directorio de usuarios.
+        """
+        print("Cargando hojas de referencia (batchGet)...")
+        ranges = [quote_sheet_title(title) for title in REFERENCE_SHEETS]
+        ranges.append(f"{quote_sheet_title(self.worksheet.title)}!1:1")
+        response = self.spreadsheet.values_batch_get(ranges, params={'valueRenderOption': 'FORMATTED_VALUE'})
+        value_ranges = [vr.get('values', []) for vr in response.get('valueRanges', [])]
+        if len(value_ranges) != len(ranges):
+            raise Exception(f"batchGet devolvió {len(value_ranges)} rangos de {len(ranges)}")
+        product_values, specs_values, users_values, record_headers = value_ranges
 
-    def get_all_products_flat(self):
+        product_records = records_from_values(product_values)
+        self._replicate('replace_reference', "Productos", product_records)
+        self._set_product_records(product_records)
+        self._products_loaded_at = time.monotonic()
+
+        specs_records = records_from_values(specs_values)
+        self._replicate('replace_reference', "Maestro Especificaciones", specs_records)
+        self._specs_data = build_specs_data(specs_records)
+
+        with self._users_lock:
+            users = self._users_with_pending_writes(records_from_values(users_values))
+            self._set_users(users)
+        self._save_snapshot('referencias', {
+            'productos': product_records, 'especificaciones': self._specs_data,
+        })
+
+        # Si los encabezados de certificados cambiaron, la caché se recarga completa en la próxima lectura.
+        record_headers = record_headers[0] if record_headers else []
+        with self._records_lock:
+            if self._records_headers is not None and list(record_headers) != list(self._records_headers):
+                self._records_cache = None
+        print("Hojas de referencia cargadas.")
+
+    def _set_product_records(self, records):
+        """Reconstruye el catálogo y sus estructuras derivadas a partir de las filas de Productos."""
+        with self._products_lock:
+            self._product_records = list(records)
+            self._product_rows = {}
+            for i, record in enumerate(self._product_records):
+                self._product_rows.setdefault((record.get('PRODUCTO'), record.get('PRESENTACION')), i + 2)
+            self._rebuild_product_views()
+
+    def _rebuild_product_views(self):
+        # El catálogo agrupado, la lista plana y las presentaciones únicas se calculan una
+        # sola vez por cambio, no en cada petición.
+        self._product_data = build_product_data(self._product_records)
         flat_list = []
-        for product_name, data in self.product_data.items():
+        for product_name, data in self._product_data.items():
             for presentation in data.get('presentaciones', []):
                 flat_list.append({
                     'PRODUCTO': product_name,
                     'PRESENTACION': presentation,
                     'FORMA_FARMACEUTICA': data.get('forma', '')
                 })
-        return flat_list
+        self._products_flat = flat_list
+        self._unique_presentations = sorted({item['PRESENTACION'] for item in flat_list})
+        self._product_data_json = None
+        self._products_version += 1
+
+    def get_product_data_json(self):
+        """Catálogo agrupado ya serializado para el formulario (se regenera solo al cambiar)."""
+        self._ensure_data_loaded()
+        with self._products_lock:
+            if self._product_data_json is None:
+                self._product_data_json = json.dumps(self._product_data or {})
+            return self._product_data_json
+
+    def get_all_products_flat(self):
+        self._ensure_data_loaded()
+        return list(self._products_flat)
 
     def get_unique_presentations(self):
-        all_presentations = set()
-        if not self.product_data:
-            return []
-        for product_info in self.product_data.values():
-            for presentation in product_info.get('presentaciones', []):
-                all_presentations.add(presentation)
-        return sorted(list(all_presentations))
+        self._ensure_data_loaded()
+        return list(self._unique_presentations)
+
+    def _refresh_products(self, force=False):
+        """Relee la hoja Productos si el catálogo tiene más de PRODUCTS_CACHE_TTL segundos (o si se fuerza)."""
+        with self._products_lock:
+            if not force and time.monotonic() - self._products_loaded_at <= PRODUCTS_CACHE_TTL:
+                return
+            try:
+                values = self._worksheet("Productos").get_all_values(value_render_option='FORMATTED_VALUE')
+            except Exception:
+                self._forget_worksheet("Productos")
+                raise
+            product_records = records_from_values(values)
+            self._set_product_records(product_records)
+            self._products_loaded_at = time.monotonic()
+        self._replicate('replace_reference', "Productos", product_records)
+
+    def _locate_product_row(self, product_sheet, product_name, presentation):
+        """
+        Devuelve la fila de la presentación según el catálogo, comprobada con una sola
+        lectura de fila (como _locate_user_row).
+
+        Otro worker puede haber añadido o borrado presentaciones y desplazado las filas;
+        en ese caso se relee el catálogo una vez antes de darla por no encontrada.
+        """
+        for attempt in range(2):
+            self._refresh_products(force=attempt > 0)
+            row = self._product_rows.get((product_name, presentation))
+            if row is None:
+                continue
+            values = product_sheet.row_values(row) + [''] * len(PRODUCT_COLUMNS)
+            if (str(values[0]), str(values[2])) == (str(product_name), str(presentation)):
+                return row
+        return None
 
     def add_product_presentation(self, product_data):
+        """
+        Añade una presentación con una sola escritura en Google Sheets.
+
+        La validación de duplicados se hace contra el catálogo en memoria (releído si
+        tiene más de PRODUCTS_CACHE_TTL segundos) y, tras el append, el catálogo se
+        actualiza en el lugar sin volver a leer la hoja.
+        """
         try:
-            product_sheet = self.spreadsheet.worksheet("Productos")
-            records = product_sheet.get_all_records()
-            for rec in records:
-                if rec.get('PRODUCTO') == product_data[0] and rec.get('PRESENTACION') == product_data[2]:
+            self._ensure_data_loaded()
+            with self._products_lock:
+                self._refresh_products()
+                key = (product_data[0], product_data[2])
+                if key in self._product_rows:
                     return False, "Esta presentación para este producto ya existe."
-            product_sheet.append_row(product_data, value_input_option='USER_ENTERED')
+                product_sheet = self._worksheet("Productos")
+                response = product_sheet.append_row(product_data, value_input_option='USER_ENTERED')
+                record = dict(zip(PRODUCT_COLUMNS, product_data))
+                expected_row = len(self._product_records) + 2
+                if self._row_from_append_response(response) not in (None, expected_row):
+                    # La hoja cambió por fuera de esta aplicación: se recarga en la próxima lectura.
+                    self._product_data = None
+                else:
+                    self._product_records.append(record)
+                    self._product_rows[key] = expected_row
+                    self._rebuild_product_views()
+                    self._replicate('replace_reference', "Productos", self._product_records)
             return True, "Presentación de producto añadida con éxito."
         except Exception as e:
+            self._forget_worksheet("Productos")
             return False, f"Error al añadir producto: {e}"
 
     def delete_product_presentation(self, product_name, presentation):
+        """
+        Elimina una presentación usando la fila indexada. Antes de borrar se lee esa fila
+        para confirmar que sigue siendo la presentación pedida (ver _locate_product_row).
+        """
         try:
-            product_sheet = self.spreadsheet.worksheet("Productos")
-            records = product_sheet.get_all_records()
-            row_to_delete = -1
-            for i, rec in enumerate(records):
-                if rec.get('PRODUCTO') == product_name and rec.get('PRESENTACION') == presentation:
-                    row_to_delete = i + 2
-                    break
-            if row_to_delete != -1:
+            self._ensure_data_loaded()
+            with self._products_lock:
+                product_sheet = self._worksheet("Productos")
+                row_to_delete = self._locate_product_row(product_sheet, product_name, presentation)
+                if row_to_delete is None:
+                    return False, "No se encontró la presentación a eliminar."
                 product_sheet.delete_rows(row_to_delete)
-                return True, "Presentación eliminada con éxito."
-            else:
-                return False, "No se encontró la presentación a eliminar."
+                # Las filas posteriores suben una posición.
+                del self._product_records[row_to_delete - 2]
+                self._product_rows = {
+                    k: (r - 1 if r > row_to_delete else r)
+                    for k, r in self._product_rows.items() if r != row_to_delete
+                }
+                self._rebuild_product_views()
+                self._replicate('replace_reference', "Productos", self._product_records)
+            return True, "Presentación eliminada con éxito."
         except Exception as e:
+            self._forget_worksheet("Productos")
             return False, f"Error al eliminar la presentación: {e}"
 
+    @property
+    def records_version(self):
+        """
+        Versión actual de los certificados (cambia con cada recarga o escritura).
+
+        Antes se pone al día la caché si venció el TTL, igual que en una lectura. Con
+        réplica se incluye además su marca de cambio, porque query_records lee de ella y
+        otros workers también la actualizan.
+        """
+        self._refresh_records_for_read()
+        if self.replica:
+            return self._records_version, self.replica.changed_at(RECORDS_SHEET)
+        return self._records_version
+
     def get_all_records(self):
+        """Devuelve los certificados desde la caché en memoria, recargándola si expiró el TTL."""
+        if not self.worksheet: return []
+        with self._records_lock:
+            self._refresh_records()
+            # Se devuelve una copia de la lista para que los llamadores puedan
+            # reordenarla o filtrarla sin alterar la caché compartida. Las altas propias
+            # aún en cola van al final.
+            return list(self._records_cache) + list(self._pending_records.values())
+
+    def _refresh_records(self):
+        """Pone al día la caché (y la réplica) si expiró el TTL."""
+        if not self.worksheet: return
+        with self._records_lock:
+            now = time.monotonic()
+            if self._records_cache is None or now - self._records_full_loaded_at > RECORDS_FULL_REFRESH_INTERVAL:
+                self._full_refresh_records()
+            elif now - self._records_loaded_at > RECORDS_CACHE_TTL:
+                self._incremental_refresh_records()
+
+    def _refresh_records_for_read(self):
+        """Como _refresh_records, pero si Sheets falla y hay réplica se sigue sirviendo desde ella."""
+        try:
+            self._refresh_records()
+        except Exception as e:
+            if not self.replica: raise
+            print(f"Advertencia: No se pudo actualizar desde Google Sheets ({e}). Se usa la réplica local.")
+
+    def query_records(self, search_term='', fecha_inicio=None, fecha_fin=None, producto=None,
+                      require_date=True, limit=None, offset=0):
+        """
+        Filtra los certificados y los devuelve del más reciente al más antiguo.
+
+        Con réplica SQLite los filtros se resuelven como consultas indexadas; sin ella,
+        se aplican sobre la caché en memoria. Ver SQLiteReplica.query_records para los
+        parámetros.
+
+        Returns:
+            tuple: (lista de registros de la página, total de registros filtrados)
+        """
+        self._refresh_records_for_read()
+        if self.replica:
+            try:
+                return self.replica.query_records(search_term, fecha_inicio, fecha_fin, producto,
+                                                  require_date, limit, offset)
+            except Exception as e:
+                print(f"Advertencia: Falló la consulta a la réplica SQLite: {e}")
+        return self._query_cached_records(search_term, fecha_inicio, fecha_fin, producto,
+                                          require_date, limit, offset)
+
+    def query_records_after(self, search_term='', fecha_inicio=None, fecha_fin=None, producto=None,
+                            after=None, limit=100):
+        """Paginación por cursor (ver SQLiteReplica.query_records_after), con réplica o sobre la caché."""
+        self._refresh_records_for_read()
+        if self.replica:
+            try:
+                return self.replica.query_records_after(search_term, fecha_inicio, fecha_fin, producto, after, limit)
+            except Exception as e:
+                print(f"Advertencia: Falló la consulta a la réplica SQLite: {e}")
+        with self._records_lock:
+            return filter_records_after(self._records_cache or [], search_term, fecha_inicio, fecha_fin,
+                                        producto, after, limit, date_index=self._cached_date_index())
+
+    def summary_counts(self, producto=None, fecha_inicio=None, fecha_fin=None):
+        """Recuentos del dashboard (ver SQLiteReplica.summary_counts), con réplica o sobre la caché."""
+        self._refresh_records_for_read()
+        if self.replica:
+            try:
+                return self.replica.summary_counts(producto, fecha_inicio, fecha_fin)
+            except Exception as e:
+                print(f"Advertencia: Falló la consulta a la réplica SQLite: {e}")
+        with self._records_lock:
+            return summary_counts(self._cached_date_index(), producto, fecha_inicio, fecha_fin)
+
+    def _cached_date_index(self):
+        records = self._records_cache or []
+        if self._records_date_index is None or len(self._records_date_index) != len(records):
+            self._records_date_index = RecordDateIndex(records)
+        return self._records_date_index
+
+    def _query_cached_records(self, search_term, fecha_inicio, fecha_fin, producto, require_date, limit, offset):
+        with self._records_lock:
+            return filter_records(self._records_cache or [], search_term, fecha_inicio, fecha_fin, producto,
+                                  require_date, limit, offset, date_index=self._cached_date_index())
+
+    def get_record_by_codigo(self, codigo, fresh=False):
+        """
+        Devuelve (fila_en_hoja, registro) del certificado con ese CODIGO, o (None, None).
+
+        La búsqueda es una consulta al índice en memoria. Si el CODIGO no está en él (por
+        ejemplo, lo creó otro worker después de la última actualización) se consulta la
+        réplica. Con fresh=True se vuelve a leer solo esa fila de la hoja, útil antes de
+        editar para no partir de una copia desactualizada.
+        """
+        codigo = str(codigo)
+        self._refresh_records_for_read()
+        with self._records_lock:
+            # Un alta propia aún en cola no tiene fila: update_record la modifica en la cola.
+            if codigo in self._pending_records:
+                return None, self._pending_records[codigo]
+            sheet_row, record = self._codigo_index.get(codigo, (None, None))
+        if sheet_row is None and self.replica:
+            try:
+                sheet_row, record = self.replica.get_record_by_codigo(codigo)
+            except Exception as e:
+                print(f"Advertencia: Falló la consulta a la réplica SQLite: {e}")
+        if sheet_row is not None and fresh and self.worksheet:
+            # Si hay escrituras de este certificado en la cola, la hoja todavía no las
+            # refleja y la copia en memoria es la más reciente.
+            if self.write_queue and self.write_queue.has_pending(self.worksheet.title, codigo):
+                return sheet_row, record
+            return self._read_record_row(codigo, sheet_row)
+        return sheet_row, record
+
+    def _read_record_row(self, codigo, sheet_row):
+        """Lee una sola fila de la hoja y comprueba que siga siendo el certificado esperado."""
+        headers = self._records_headers or get_column_order()
+        last_column = gspread.utils.rowcol_to_a1(1, len(headers)).rstrip('0123456789')
+        values = self.worksheet.get(f'A{sheet_row}:{last_column}{sheet_row}', value_render_option='FORMATTED_VALUE')
+        record = self._build_records(headers, values[:1])[0] if values else None
+        if record and str(record.get('CODIGO')) == codigo:
+            with self._records_lock:
+                if self._records_cache is not None and 0 <= sheet_row - 2 < len(self._records_cache):
+                    self._records_cache[sheet_row - 2] = record
+                    self._records_date_index.replace(sheet_row - 2, record)
+                self._index_records(sheet_row, [record], replace=True)
+            self._replicate('upsert_records', sheet_row, [record])
+            return sheet_row, record
+        # Las filas se desplazaron (se borró alguna): se recarga la hoja y se busca de nuevo.
+        with self._records_lock:
+            self._full_refresh_records()
+            return self._codigo_index.get(codigo, (None, None))
+
+    def _index_records(self, first_row, records, replace=False):
+        """
+        Agrega registros consecutivos (desde first_row) al índice por CODIGO. Un alta
+        propia que ya aparece en la hoja deja de estar pendiente, la haya enviado este
+        proceso u otro.
+        """
+        with self._records_lock:
+            for i, record in enumerate(records):
+                codigo = str(record.get('CODIGO', ''))
+                if not codigo: continue
+                self._pending_records.pop(codigo, None)
+                # Si un CODIGO aparece repetido se conserva la primera fila, como hacía
+                # la búsqueda lineal anterior.
+                if replace or codigo not in self._codigo_index:
+                    self._codigo_index[codigo] = (first_row + i, record)
+
+    def invalidate_records_cache(self):
+        """Fuerza que la próxima lectura de registros vuelva a Google Sheets."""
+        with self._records_lock:
+            self._records_cache = None
+            self._records_headers = None
+            self._codigo_index = {}
+            self._records_version += 1
+
+    def _full_refresh_records(self):
         # --- INICIO DE LA CORRECCIÓN ---
         # Se usa get_all_values con value_render_option='FORMATTED_VALUE' para obtener
         # los datos tal como se ven en la hoja (texto), evitando la conversión automática
         # de '0123' a 123. Luego, se construyen los diccionarios manualmente.
-        if not self.worksheet: return []
+        read_started_at = time.time()
+        records_version = self._records_version
+        pending_before = self._pending_writes(self.worksheet.title)
         all_values = self.worksheet.get_all_values(value_render_option='FORMATTED_VALUE')
-        if not all_values or len(all_values) < 2:
-            return []
-        headers = all_values[0]
+        headers = all_values[0] if all_values else []
         
         # Debug: Verificar si faltan columnas NOTA en los encabezados
-        expected_headers = get_column_order()
-        missing_headers = [h for h in expected_headers if h not in headers]
-        if missing_headers:
+        missing_headers = [h for h in get_column_order() if h not in headers]
+        if headers and missing_headers:
             print(f"ADVERTENCIA: Faltan {len(missing_headers)} columnas en Google Sheets headers")
             if any('NOTA' in h for h in missing_headers):
                 print("  ⚠️  Faltan columnas NOTA. Ejecuta sync_headers() para sincronizar.")
-        
-        # Construir registros con todas las columnas esperadas
-        records = []
-        for row in all_values[1:]:
-            # Extender row si es más corta que headers
-            row_extended = list(row) + [''] * (len(headers) - len(row))
-            record = dict(zip(headers, row_extended))
-            
-            # Agregar columnas faltantes con valores vacíos
-            for expected_col in expected_headers:
-                if expected_col not in record:
-                    record[expected_col] = ''
-            
-            records.append(record)
-        
-        return records
-    
+
+        records = self._build_records(headers, all_values[1:])
+        # La lectura de la hoja se hace sin el candado; solo el reemplazo de la caché lo toma.
+        # Las modificaciones que estaban en la cola al empezar se vuelven a aplicar aunque se
+        # hayan confirmado mientras tanto (ver _with_pending_writes); las altas confirmadas
+        # mientras tanto cambian _records_version y obligan a repetir la lectura.
+        with self._records_lock:
+            if self._records_version != records_version:
+                # Este proceso escribió o recargó certificados mientras se leía: la lectura
+                # podría no incluir esos cambios, así que se repite ya con el candado tomado.
+                read_started_at = time.time()
+                pending_before = self._pending_writes(self.worksheet.title)
+                all_values = self.worksheet.get_all_values(value_render_option='FORMATTED_VALUE')
+                headers = all_values[0] if all_values else []
+                records = self._build_records(headers, all_values[1:])
+            self._set_records_cache(headers, records, pending_before)
+            self._replicate('replace_records', self._records_cache, read_started_at)
+        self._save_records_snapshot()
+
+    def _set_records_cache(self, headers, records, pending_before=()):
+        """
+        Reemplaza la caché de certificados y su índice. Se aplican las modificaciones aún
+        en cola; las altas no, porque su fila no se conoce hasta enviarlas.
+        """
+        self._records_headers = headers
+        self._records_cache = self._with_pending_writes(
+            self.worksheet.title, records,
+            record_from_row, lambda record: str(record.get('CODIGO', '')), pending_before, appends=False
+        )
+        self._codigo_index = {}
+        self._index_records(2, self._records_cache)
+        self._records_date_index = RecordDateIndex(self._records_cache)
+        self._seed_codigo_allocator(self._records_cache)
+        self._records_loaded_at = self._records_full_loaded_at = time.monotonic()
+        self._records_version += 1
+
+    def _incremental_refresh_records(self):
+        """Descarga solo las filas añadidas desde la última lectura.
+
+        Los certificados solo se agregan al final de la hoja, así que basta con pedir
+        desde la última fila conocida en adelante (en la misma llamada se pide la fila
+        de encabezados). Si los encabezados cambiaron o la última fila conocida ya no
+        contiene el mismo CODIGO (se borraron o movieron filas), se hace una recarga completa.
+        """
+        headers = self._records_headers
+        if not headers or not self._records_cache or 'CODIGO' not in headers:
+            return self._full_refresh_records()
+
+        last_row = len(self._records_cache) + 1  # +1 por la fila de encabezados
+        last_column = gspread.utils.rowcol_to_a1(1, len(headers)).rstrip('0123456789')
+        current_headers, tail = self.worksheet.batch_get(
+            ['1:1', f'A{last_row}:{last_column}'], value_render_option='FORMATTED_VALUE'
+        )
+        current_headers = current_headers[0] if current_headers else []
+        codigo_index = headers.index('CODIGO')
+        last_codigo = self._records_cache[-1].get('CODIGO', '')
+        tail_codigo = tail[0][codigo_index] if tail and len(tail[0]) > codigo_index else None
+        if list(current_headers) != list(headers) or tail_codigo != last_codigo:
+            print("La hoja de certificados cambió de estructura. Se recarga completa.")
+            return self._full_refresh_records()
+
+        new_rows = tail[1:]
+        if new_rows:
+            new_records = self._build_records(headers, new_rows)
+            self._records_cache.extend(new_records)
+            self._records_date_index.extend(new_records)
+            self._index_records(last_row + 1, new_records)
+            self._seed_codigo_allocator(new_records)
+            self._records_version += 1
+            self._replicate('upsert_records', last_row + 1, new_records)
+            self._save_records_snapshot()
+        self._records_loaded_at = time.monotonic()
+
+    def _build_records(self, headers, rows):
+        # Todas las filas de una misma lectura comparten el esquema de sus encabezados,
+        # que incluye las columnas esperadas que falten en la hoja (con valor '').
+        schema = schema_for(headers)
+        return [schema.make(row) for row in rows]
+
     def sync_headers(self):
         """Sincroniza los encabezados de Google Sheets con las columnas esperadas"""
         if not self.worksheet:
@@ -248,6 +891,7 @@ class GoogleSheetManager:
             if len(current_headers) < len(expected_headers):
                 print(f"Actualizando encabezados: {len(current_headers)} -> {len(expected_headers)} columnas")
                 self.worksheet.update('A1', [expected_headers], value_input_option='USER_ENTERED')
+                self.invalidate_records_cache()
                 print("✅ Encabezados sincronizados correctamente")
                 return True
             else:
@@ -257,7 +901,47 @@ class GoogleSheetManager:
             print(f"ERROR al sincronizar encabezados: {e}")
             return False
     
+    def _ensure_codigo_allocator_seeded(self):
+        """Inicializa la secuencia con los códigos de la hoja (una sola lectura por proceso)."""
+        if self._codigo_allocator_seeded:
+            return
+        with self._records_lock:
+            if self._codigo_allocator_seeded:
+                return
+            # Si la caché ya está cargada, sus códigos bastan y no hace falta leer la columna A.
+            if self._records_cache is not None:
+                codigos = list(self._codigo_index)
+            else:
+                codigos = self.worksheet.col_values(1)[1:]
+            self.codigo_allocator.seed(codigos)
+            self._codigo_allocator_seeded = True
+
+    def _seed_codigo_allocator(self, records):
+        """Mantiene la secuencia por delante de códigos escritos en la hoja por otros medios."""
+        if self.codigo_allocator and self._codigo_allocator_seeded:
+            try:
+                self.codigo_allocator.seed(record.get('CODIGO') for record in records)
+            except Exception as e:
+                print(f"Advertencia: No se pudo actualizar la secuencia de códigos: {e}")
+
     def get_next_codigo(self):
+        """Código que recibirá el próximo certificado. No lo reserva (ver allocate_codigo)."""
+        if self.codigo_allocator and self.worksheet:
+            try:
+                self._ensure_codigo_allocator_seeded()
+                return self.codigo_allocator.peek()
+            except Exception as e:
+                print(f"Error al consultar la secuencia de códigos: {e}.")
+        return self._next_codigo_from_sheet()
+
+    def allocate_codigo(self):
+        """Reserva el código del nuevo certificado. Nunca entrega el mismo código dos veces."""
+        if self.codigo_allocator and self.worksheet:
+            self._ensure_codigo_allocator_seeded()
+            return self.codigo_allocator.allocate()
+        return self._next_codigo_from_sheet()
+
+    def _next_codigo_from_sheet(self):
         current_year = str(datetime.now().year)
         try:
             if not self.worksheet: return f"0001-{current_year}"
@@ -280,38 +964,158 @@ class GoogleSheetManager:
     
     def add_record(self, data):
         if self.worksheet:
-            self.worksheet.append_row(data, value_input_option='USER_ENTERED')
+            record = record_from_row(data)
+            if self.write_queue:
+                # La fila definitiva se conoce al enviar el lote (ver _on_append_flushed);
+                # mientras tanto el certificado solo es visible en este proceso.
+                # Se registra antes de encolar para que el envío, que puede ocurrir enseguida,
+                # siempre la encuentre. Las llamadas a la cola se hacen sin el candado de la
+                # caché, que el hilo de envío necesita para confirmar las altas.
+                codigo = str(record.get('CODIGO', ''))
+                with self._records_lock:
+                    self._pending_records[codigo] = record
+                    self._records_version += 1
+                try:
+                    self.write_queue.enqueue_append(self.worksheet.title, codigo, data)
+                except Exception:
+                    with self._records_lock:
+                        self._pending_records.pop(codigo, None)
+                    raise
+                return
+            response = self.worksheet.append_row(data, value_input_option='USER_ENTERED')
+            appended_row = self._row_from_append_response(response)
+            with self._records_lock:
+                if self._records_cache is not None:
+                    expected_row = len(self._records_cache) + 2
+                    if appended_row in (None, expected_row):
+                        self._records_cache.append(record)
+                        self._records_date_index.append(record)
+                        appended_row = expected_row
+                    else:
+                        # Otro proceso añadió filas entre medias: la caché ya no refleja
+                        # las posiciones de la hoja, así que se vuelve a leer completa.
+                        self._records_cache = None
+                if appended_row:
+                    self._index_records(appended_row, [record], replace=True)
+                self._records_version += 1
+            if appended_row:
+                self._replicate('upsert_records', appended_row, [record])
         else:
             raise Exception("No hay conexión con la hoja de registros (self.worksheet es None)")
+
+    @staticmethod
+    def _row_from_append_response(response):
+        """Obtiene el número de fila escrito a partir de la respuesta de append_row."""
+        try:
+            updated_range = response['updates']['updatedRange'].split('!')[-1]
+            return gspread.utils.a1_to_rowcol(updated_range.split(':')[0])[0]
+        except (KeyError, TypeError, AttributeError, IndexError, gspread.exceptions.IncorrectCellLabel):
+            return None
     
     def update_record(self, row_index, data):
         if self.worksheet:
-            self.worksheet.update(f'A{row_index}', [data], value_input_option='USER_ENTERED')
+            record = record_from_row(data)
+            if self.write_queue:
+                codigo = str(record.get('CODIGO', ''))
+                # Si el alta de este certificado aún no se envió, basta con cambiar sus valores.
+                if self.write_queue.merge_into_pending_append(self.worksheet.title, codigo, data):
+                    with self._records_lock:
+                        # Si el alta ya se envió, _on_append_flushed la colocó con estos valores.
+                        if codigo in self._pending_records:
+                            self._pending_records[codigo] = record
+                        self._records_version += 1
+                    return
+                with self._records_lock:
+                    self._refresh_records()
+                    row_index = self._codigo_index.get(codigo, (row_index,))[0]
+                if row_index is None:
+                    raise Exception(f"No se encontró la fila del certificado {codigo} en la hoja")
+                self.write_queue.enqueue_update(self.worksheet.title, codigo, row_index, data)
+            else:
+                self.worksheet.update(f'A{row_index}', [data], value_input_option='USER_ENTERED')
+            with self._records_lock:
+                cache_index = row_index - 2
+                if self._records_cache is not None and 0 <= cache_index < len(self._records_cache):
+                    previous_codigo = str(self._records_cache[cache_index].get('CODIGO', ''))
+                    if self._codigo_index.get(previous_codigo, (None,))[0] == row_index:
+                        del self._codigo_index[previous_codigo]
+                    # Se reemplaza el diccionario en lugar de modificarlo, porque otras
+                    # peticiones pueden estar usando la versión anterior.
+                    self._records_cache[cache_index] = record
+                    self._records_date_index.replace(cache_index, record)
+                self._index_records(row_index, [record], replace=True)
+                self._records_version += 1
+            self._replicate('upsert_records', row_index, [record])
         else:
             raise Exception("No hay conexión con la hoja de registros (self.worksheet es None)")
 
+    def _refresh_users(self, force=False):
+        """Recarga el directorio de usuarios si expiró el TTL (o si se fuerza)."""
+        with self._users_lock:
+            cache_valid = self._users_cache is not None and time.monotonic() - self._users_loaded_at <= USERS_CACHE_TTL
+            if cache_valid and not force:
+                return
+            try:
+                users = self._worksheet("Usuarios").get_all_records()
+            except Exception:
+                self._forget_worksheet("Usuarios")
+                raise
+            self._set_users(self._users_with_pending_writes(users))
+
+    def _users_with_pending_writes(self, users):
+        return self._with_pending_writes(
+            "Usuarios", users,
+            lambda values: dict(zip(USER_COLUMNS, values)), lambda user: str(user.get('USERNAME', '')).lower(),
+            columns=USER_COLUMNS
+        )
+
+    def _set_users(self, users):
+        with self._users_lock:
+            self._users_cache = users
+            self._users_index = {}
+            for i, user in enumerate(users):
+                self._users_index.setdefault(str(user.get('USERNAME', '')).lower(), (i + 2, user))
+            self._users_loaded_at = time.monotonic()
+        self._replicate('replace_reference', "Usuarios", users)
+
+    def _locate_user_row(self, users_sheet, username):
+        """
+        Devuelve la fila del usuario según el directorio, comprobada con una sola lectura de celda.
+
+        Si otro proceso borró usuarios, las filas del directorio pueden estar desplazadas;
+        en ese caso se recarga el directorio una vez antes de darlo por no encontrado.
+        """
+        for attempt in range(2):
+            self._refresh_users(force=attempt > 0)
+            entry = self._users_index.get(str(username).lower())
+            if entry and str(users_sheet.cell(entry[0], 1).value).lower() == str(username).lower():
+                return entry[0]
+        return None
+
     def get_all_users(self):
         if not self.spreadsheet:
             print("Error: No hay conexión con Google Sheets. Retornando lista vacía de usuarios.")
             return []
         try:
-            users_sheet = self.spreadsheet.worksheet("Usuarios")
-            return users_sheet.get_all_records()
+            self._refresh_users()
+            return list(self._users_cache)
         except Exception as e:
             print(f"Error al obtener usuarios: {e}")
+            if self.replica:
+                try:
+                    return self.replica.get_reference("Usuarios")
+                except Exception as replica_error:
+                    print(f"Error al leer usuarios de la réplica local: {replica_error}")
             return []
 
     def find_user(self, username):
+        """Busca un usuario por USERNAME (sin distinguir mayúsculas) en el directorio en memoria."""
         if not self.spreadsheet: return None
         try:
-            users_sheet = self.spreadsheet.worksheet("Usuarios")
-            # --- INICIO DE LA CORRECCIÓN ---
-            # Se utiliza find() que es más directo y eficiente para encontrar la celda.
-            # Se busca en la columna 1 (USERNAME) según la estructura de la hoja.
-            cell = users_sheet.find(username, in_column=1)
-            if cell:
-                return dict(zip(users_sheet.row_values(1), users_sheet.row_values(cell.row)))
-            # --- FIN DE LA CORRECCIÓN ---
+            self._refresh_users()
+            entry = self._users_index.get(str(username).lower())
+            if entry:
+                return dict(entry[1])
         except Exception as e:
             print(f"Error al buscar usuario {username}: {e}")
         return None
@@ -323,37 +1127,88 @@ class GoogleSheetManager:
         
         try:
             if not self.spreadsheet: return False, "No hay conexión con Google Sheets."
-            users_sheet = self.spreadsheet.worksheet("Usuarios")
-            # Se añade directamente el registro de 3 columnas [USERNAME, PASSWORD, ROL]
-            users_sheet.append_row(user_data, value_input_option='USER_ENTERED')
+            if self.write_queue:
+                self.write_queue.enqueue_append("Usuarios", str(username).lower(), user_data)
+                appended_row = None
+            else:
+                users_sheet = self._worksheet("Usuarios")
+                # Se añade directamente el registro de 3 columnas [USERNAME, PASSWORD, ROL]
+                response = users_sheet.append_row(user_data, value_input_option='USER_ENTERED')
+                appended_row = self._row_from_append_response(response)
+            with self._users_lock:
+                if self._users_cache is not None and appended_row in (None, len(self._users_cache) + 2):
+                    self._set_users(self._users_cache + [dict(zip(USER_COLUMNS, user_data))])
+                else:
+                    self._users_cache = None
             return True, "Usuario añadido con éxito."
         except Exception as e:
+            self._forget_worksheet("Usuarios")
             return False, f"Error al añadir usuario: {e}"
             
     def update_user(self, username, new_data):
         try:
             if not self.spreadsheet: return False, "No hay conexión con Google Sheets."
-            users_sheet = self.spreadsheet.worksheet("Usuarios")
-            cell = users_sheet.find(username, in_column=1)
-            if not cell: return False, "Usuario no encontrado."
+            changes = {key: new_data[key] for key in ('ROL', 'PASSWORD') if key in new_data}
+            if self.write_queue:
+                key = str(username).lower()
+                # Un usuario recién creado cuya alta sigue en la cola se modifica ahí mismo,
+                # a partir de los valores encolados.
+                queued = next((op['valores'] for op in self.write_queue.pending("Usuarios")
+                               if op['operacion'] == 'append' and op['clave'] == key), None)
+                merged = False
+                if queued is not None:
+                    updated_user = {**dict(zip(USER_COLUMNS, queued)), **changes}
+                    merged = self.write_queue.merge_into_pending_append(
+                        "Usuarios", key, [updated_user.get(column, '') for column in USER_COLUMNS])
+                if not merged:
+                    row = self._locate_user_row(self._worksheet("Usuarios"), username)
+                    if not row: return False, "Usuario no encontrado."
+                    # Solo las celdas que cambian, como update_cell abajo: el directorio puede
+                    # tener hasta USERS_CACHE_TTL segundos y no debe reescribir el resto de la fila.
+                    for column in ('PASSWORD', 'ROL'):
+                        if column in changes:
+                            self.write_queue.enqueue_update("Usuarios", key, row, [changes[column]],
+                                                            column=USER_COLUMNS.index(column) + 1)
+            else:
+                users_sheet = self._worksheet("Usuarios")
+                row = self._locate_user_row(users_sheet, username)
+                if not row: return False, "Usuario no encontrado."
 
-            if 'ROL' in new_data:
-                users_sheet.update_cell(cell.row, 3, new_data['ROL']) # ROL es la columna 3
+                if 'ROL' in new_data:
+                    users_sheet.update_cell(row, 3, new_data['ROL']) # ROL es la columna 3
 
-            if 'PASSWORD' in new_data:
-                users_sheet.update_cell(cell.row, 2, new_data['PASSWORD']) # PASSWORD es la columna 2
+                if 'PASSWORD' in new_data:
+                    users_sheet.update_cell(row, 2, new_data['PASSWORD']) # PASSWORD es la columna 2
 
+            with self._users_lock:
+                entry = self._users_index.get(str(username).lower())
+                if entry and self._users_cache is not None and 0 <= entry[0] - 2 < len(self._users_cache):
+                    users = list(self._users_cache)
+                    users[entry[0] - 2] = {**entry[1], **changes}
+                    self._set_users(users)
             return True, "Usuario actualizado con éxito."
         except Exception as e:
+            self._forget_worksheet("Usuarios")
             return False, f"Error al actualizar usuario: {e}"
 
     def delete_user(self, username):
         try:
             if not self.spreadsheet: return False, "No hay conexión con Google Sheets."
-            users_sheet = self.spreadsheet.worksheet("Usuarios")
-            cell_to_delete = users_sheet.find(username, in_column=1)
-            if not cell_to_delete: return False, "Usuario no encontrado para eliminar."
-            users_sheet.delete_rows(cell_to_delete.row)
+            if self.write_queue:
+                # Borrar desplaza las filas siguientes, así que antes se envían las escrituras
+                # encoladas para que sus números de fila sigan siendo válidos.
+                self.write_queue.flush()
+            users_sheet = self._worksheet("Usuarios")
+            row_to_delete = self._locate_user_row(users_sheet, username)
+            if not row_to_delete: return False, "Usuario no encontrado para eliminar."
+            users_sheet.delete_rows(row_to_delete)
+            with self._users_lock:
+                # Las filas posteriores suben una posición; el índice se recalcula sin leer la hoja.
+                if self._users_cache is not None and 0 <= row_to_delete - 2 < len(self._users_cache):
+                    self._set_users(self._users_cache[:row_to_delete - 2] + self._users_cache[row_to_delete - 1:])
+                else:
+                    self._users_cache = None
             return True, "Usuario eliminado con éxito."
         except Exception as e:
-            return False, f"Error al eliminar usuario: {e}"
\ No newline at end of file
+            self._forget_worksheet("Usuarios")
+            return False, f"Error al eliminar usuario: {e}"
@@ -0,0 +1,40 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+class ResponseCache:
+    """
+    Caché LRU, por proceso, de respuestas ya renderizadas.
+
+    Guarda el cuerpo listo para enviar y su ETag (hash del contenido). La clave debe
+    incluir la versión de los datos de los que depende la respuesta, de modo que tras
+    cualquier cambio se use una clave nueva y las entradas antiguas simplemente dejen
+    de pedirse hasta que salgan por el extremo LRU.
+    """
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_render(self, key, render):
+        """
+        Devuelve (cuerpo, etag) de `key`; si no está, llama a `render()` (que devuelve
+        bytes) y guarda el resultado.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry
+        # Se renderiza fuera del candado: dos peticiones iguales a la vez solo hacen el
+        # trabajo dos veces, sin bloquear al resto.
+        body = render()
+        entry = (body, hashlib.sha1(body).hexdigest())
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
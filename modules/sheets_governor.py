@@ -0,0 +1,148 @@
+import random
+import threading
+import time
+
+# Respuestas de la API que indican cuota agotada o sobrecarga temporal y merecen reintento.
+RETRY_STATUSES = (429, 500, 503)
+# Las escrituras solo se reintentan ante 429, que garantiza que no se ejecutaron: un 500 o
+# un 503 no dicen si un values:append llegó a escribir, y repetirlo duplicaría la fila.
+WRITE_RETRY_STATUSES = (429,)
+
+
+class QuotaWaitTimeout(Exception):
+    """La llamada esperó más de lo permitido a que hubiera cuota disponible."""
+
+
+class TokenBucket:
+    """
+    Cubo de fichas para una clase de cuota de la API (lecturas o escrituras por minuto).
+
+    Admite ráfagas de hasta `burst` llamadas y se rellena al ritmo justo para que, en
+    cualquier ventana de 60 segundos, no se consuman más de `per_minute` fichas.
+    """
+
+    def __init__(self, per_minute, burst):
+        self.per_minute = per_minute
+        self.capacity = max(1, min(burst, per_minute))
+        self.rate = max(per_minute - self.capacity, 1) / 60.0
+        self.tokens = float(self.capacity)
+        self.updated_at = time.monotonic()
+        self.waiting = 0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def acquire(self, max_wait):
+        """Toma una ficha, esperando lo necesario. Devuelve los segundos esperados."""
+        started = time.monotonic()
+        with self._lock:
+            self.waiting += 1
+        try:
+            while True:
+                with self._lock:
+                    now = time.monotonic()
+                    self._refill(now)
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return now - started
+                    delay = (1 - self.tokens) / self.rate
+                if now - started + delay > max_wait:
+                    raise QuotaWaitTimeout(f"Sin cuota disponible de Google Sheets tras {max_wait:.0f} s de espera")
+                time.sleep(delay)
+        finally:
+            with self._lock:
+                self.waiting -= 1
+
+    def drain(self):
+        """Vacía el cubo: la API ya indicó que la cuota se agotó (p. ej. por otro proceso)."""
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens = min(self.tokens, 0.0)
+
+    def available(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            return self.tokens
+
+
+class QuotaGovernor:
+    """
+    Regula el tráfico hacia la API de Google Sheets de un proceso.
+
+    Cada llamada toma antes una ficha del cubo de su clase ('lectura' o 'escritura'), de
+    modo que bajo carga las peticiones esperan su turno en lugar de agotar la cuota. Si
+    aun así la API responde 429 (otros procesos comparten la cuota) la llamada se
+    reintenta con espera exponencial con jitter, respetando Retry-After si viene. Las
+    llamadas idempotentes (lecturas) también se reintentan ante 500 y 503.
+    """
+
+    def __init__(self, quotas, burst=10, max_retries=5, backoff_base=1.0, backoff_max=32.0, max_wait=60.0):
+        """
+        Args:
+            quotas (dict): Clase de cuota -> llamadas permitidas por minuto.
+            burst (int): Llamadas seguidas que se permiten sin esperar.
+            max_retries (int): Reintentos (ver RETRY_STATUSES) antes de devolver la respuesta de error.
+            backoff_base (float): Espera base (segundos) del primer reintento.
+            backoff_max (float): Espera máxima entre reintentos.
+            max_wait (float): Segundos máximos que una llamada espera por cuota antes de fallar.
+        """
+        self.buckets = {name: TokenBucket(per_minute, burst) for name, per_minute in quotas.items()}
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_wait = max_wait
+        self._stats_lock = threading.Lock()
+        self._stats = {name: {'llamadas': 0, 'reintentos': 0, 'limitadas': 0, 'espera_total': 0.0}
+                       for name in quotas}
+
+    def _count(self, quota, key, amount=1):
+        with self._stats_lock:
+            self._stats[quota][key] += amount
+
+    def backoff_delay(self, attempt, response=None):
+        """Espera antes del reintento `attempt` (0, 1, ...): Retry-After o exponencial con jitter completo."""
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after:
+            try:
+                return min(float(retry_after), self.backoff_max)
+            except ValueError:
+                pass
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def run(self, quota, send, idempotent=True):
+        """
+        Ejecuta `send()` (que devuelve una respuesta HTTP) respetando la cuota `quota`.
+        Con idempotent=False solo se reintenta ante WRITE_RETRY_STATUSES.
+        """
+        bucket = self.buckets[quota]
+        retry_statuses = RETRY_STATUSES if idempotent else WRITE_RETRY_STATUSES
+        for attempt in range(self.max_retries + 1):
+            self._count(quota, 'espera_total', bucket.acquire(self.max_wait))
+            self._count(quota, 'llamadas')
+            response = send()
+            if response.status_code not in retry_statuses or attempt == self.max_retries:
+                return response
+            if response.status_code == 429:
+                self._count(quota, 'limitadas')
+                bucket.drain()
+            self._count(quota, 'reintentos')
+            time.sleep(self.backoff_delay(attempt, response))
+        return response
+
+    def headroom(self):
+        """Estado de cada clase de cuota: fichas disponibles, límites, esperas y reintentos."""
+        with self._stats_lock:
+            stats = {name: {**values, 'espera_total': round(values['espera_total'], 2)}
+                     for name, values in self._stats.items()}
+        return {
+            name: {
+                'disponibles': round(bucket.available(), 2),
+                'rafaga': bucket.capacity,
+                'por_minuto': bucket.per_minute,
+                'en_espera': bucket.waiting,
+                **stats[name],
+            }
+            for name, bucket in self.buckets.items()
+        }
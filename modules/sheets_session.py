@@ -0,0 +1,50 @@
+import threading
+from datetime import datetime, timedelta, timezone
+import requests
+from google.auth.transport.requests import AuthorizedSession, Request
+
+
+class PooledAuthorizedSession(AuthorizedSession):
+    """
+    Sesión HTTP autorizada y compartida por todas las llamadas de gspread de un proceso.
+
+    Mantiene un pool de conexiones keep-alive hacia la API (sin repetir el saludo TLS en
+    cada llamada) del tamaño de los hilos que atienden peticiones, y renueva el token de
+    la cuenta de servicio `refresh_margin` segundos antes de que expire, con un solo hilo
+    a la vez, en lugar de esperar a que una llamada falle o se quede sin token.
+
+    Si se indica un `governor` (QuotaGovernor), cada llamada pasa por él: las GET cuentan
+    como lecturas y el resto como escrituras, que no se reintentan ante errores del
+    servidor (ver WRITE_RETRY_STATUSES).
+    """
+
+    def __init__(self, credentials, pool_size=10, refresh_margin=300, governor=None):
+        super().__init__(credentials)
+        self.governor = governor
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.mount('https://', adapter)
+        self.refresh_margin = timedelta(seconds=refresh_margin)
+        self._refresh_lock = threading.Lock()
+        self._token_request = Request()
+
+    def _token_is_fresh(self):
+        # google-auth guarda `expiry` como datetime UTC sin zona horaria.
+        expiry = getattr(self.credentials, 'expiry', None)
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        return bool(self.credentials.token) and expiry is not None and expiry - now > self.refresh_margin
+
+    def refresh_token_if_needed(self):
+        if self._token_is_fresh():
+            return
+        with self._refresh_lock:
+            if not self._token_is_fresh():
+                self.credentials.refresh(self._token_request)
+
+    def request(self, method, url, *args, **kwargs):
+        self.refresh_token_if_needed()
+        if self.governor is None:
+            return super().request(method, url, *args, **kwargs)
+        is_read = method.upper() == 'GET'
+        return self.governor.run('lectura' if is_read else 'escritura',
+                                 lambda: super(PooledAuthorizedSession, self).request(method, url, *args, **kwargs),
+                                 idempotent=is_read)
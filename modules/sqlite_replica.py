@@ -0,0 +1,553 @@
+import os
+import sqlite3
+import threading
+import json
+import time
+from datetime import date, datetime, timedelta
+
+# Conexiones abiertas antes de un fork; se conservan para que el recolector no las cierre en el hijo.
+_inherited_connections = []
+
+# Hojas de referencia que se copian tal cual (una fila de la hoja = una fila de la tabla):
+# nombre de la hoja -> (tabla, columnas de la hoja que se guardan aparte para indexarlas).
+REFERENCE_TABLES = {
+    'Productos': ('productos', ['PRODUCTO', 'PRESENTACION']),
+    'Usuarios': ('usuarios', ['USERNAME']),
+    'Maestro Especificaciones': ('especificaciones', ['PRODUCTO', 'VER']),
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS certificados (
+    sheet_row INTEGER PRIMARY KEY,
+    codigo TEXT,
+    producto TEXT,
+    conclusion TEXT,
+    fecha_registro TEXT,
+    search_text TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_certificados_codigo ON certificados (codigo);
+CREATE INDEX IF NOT EXISTS idx_certificados_fecha ON certificados (fecha_registro);
+CREATE INDEX IF NOT EXISTS idx_certificados_producto_fecha ON certificados (producto, fecha_registro);
+
+-- Recuentos materializados para el dashboard: certificados por producto, día de registro
+-- ('' si no tiene fecha válida) y CONCLUSION. Los mantienen los triggers de SUMMARY_TRIGGERS.
+CREATE TABLE IF NOT EXISTS resumen_certificados (
+    producto TEXT NOT NULL,
+    dia TEXT NOT NULL,
+    conclusion TEXT NOT NULL,
+    total INTEGER NOT NULL,
+    PRIMARY KEY (producto, dia, conclusion)
+);
+CREATE INDEX IF NOT EXISTS idx_resumen_certificados_dia ON resumen_certificados (dia);
+
+CREATE TABLE IF NOT EXISTS productos (
+    sheet_row INTEGER PRIMARY KEY,
+    producto TEXT,
+    presentacion TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_productos_producto ON productos (producto, presentacion);
+
+CREATE TABLE IF NOT EXISTS usuarios (
+    sheet_row INTEGER PRIMARY KEY,
+    username TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_usuarios_username ON usuarios (username COLLATE NOCASE);
+
+CREATE TABLE IF NOT EXISTS especificaciones (
+    sheet_row INTEGER PRIMARY KEY,
+    producto TEXT,
+    ver TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_especificaciones_producto ON especificaciones (producto, ver);
+
+CREATE TABLE IF NOT EXISTS sync_estado (
+    hoja TEXT PRIMARY KEY,
+    sincronizado_en REAL,
+    filas INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS actividad (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    fecha TEXT NOT NULL,
+    usuario TEXT,
+    accion TEXT NOT NULL,
+    detalles TEXT
+);
+"""
+
+# Índice invertido de la búsqueda de certificados: FTS5 con tokenizador de trigramas,
+# que responde búsquedas por subcadena (no solo por palabra completa) desde el índice.
+# Es una tabla de contenido externo sobre certificados.search_text que los triggers
+# mantienen al día en cada inserción, reemplazo o borrado de certificados.
+SEARCH_INDEX = """
+CREATE VIRTUAL TABLE IF NOT EXISTS certificados_busqueda USING fts5(
+    search_text, content='certificados', content_rowid='sheet_row', tokenize='trigram'
+)
+"""
+SEARCH_INDEX_TRIGGERS = {
+    'certificados_busqueda_ai': """
+        CREATE TRIGGER IF NOT EXISTS certificados_busqueda_ai AFTER INSERT ON certificados BEGIN
+            INSERT INTO certificados_busqueda (rowid, search_text) VALUES (new.sheet_row, new.search_text);
+        END""",
+    'certificados_busqueda_ad': """
+        CREATE TRIGGER IF NOT EXISTS certificados_busqueda_ad AFTER DELETE ON certificados BEGIN
+            INSERT INTO certificados_busqueda (certificados_busqueda, rowid, search_text)
+            VALUES ('delete', old.sheet_row, old.search_text);
+        END""",
+    'certificados_busqueda_au': """
+        CREATE TRIGGER IF NOT EXISTS certificados_busqueda_au AFTER UPDATE ON certificados BEGIN
+            INSERT INTO certificados_busqueda (certificados_busqueda, rowid, search_text)
+            VALUES ('delete', old.sheet_row, old.search_text);
+            INSERT INTO certificados_busqueda (rowid, search_text) VALUES (new.sheet_row, new.search_text);
+        END""",
+}
+
+_SUMMARY_KEY = "COALESCE({0}.producto, ''), COALESCE(substr({0}.fecha_registro, 1, 10), ''), COALESCE({0}.conclusion, '')"
+_SUMMARY_ADD = (
+    "INSERT INTO resumen_certificados (producto, dia, conclusion, total) VALUES ({}, 1) "
+    "ON CONFLICT (producto, dia, conclusion) DO UPDATE SET total = total + 1;"
+).format(_SUMMARY_KEY.format('new'))
+_SUMMARY_REMOVE = (
+    "UPDATE resumen_certificados SET total = total - 1 "
+    "WHERE (producto, dia, conclusion) = ({});"
+).format(_SUMMARY_KEY.format('old'))
+SUMMARY_TRIGGERS = {
+    'resumen_certificados_ai': f"""
+        CREATE TRIGGER IF NOT EXISTS resumen_certificados_ai AFTER INSERT ON certificados BEGIN
+            {_SUMMARY_ADD}
+        END""",
+    'resumen_certificados_ad': f"""
+        CREATE TRIGGER IF NOT EXISTS resumen_certificados_ad AFTER DELETE ON certificados BEGIN
+            {_SUMMARY_REMOVE}
+        END""",
+    'resumen_certificados_au': f"""
+        CREATE TRIGGER IF NOT EXISTS resumen_certificados_au
+        AFTER UPDATE OF producto, fecha_registro, conclusion ON certificados BEGIN
+            {_SUMMARY_REMOVE}
+            {_SUMMARY_ADD}
+        END""",
+}
+
+# Combinaciones de filtros cuyo total se recuerda (ver SQLiteReplica.query_records).
+MAX_CACHED_TOTALS = 256
+
+# Los trigramas solo sirven para términos de al menos 3 caracteres; los más cortos se
+# filtran recorriendo search_text.
+MIN_INDEXED_TERM = 3
+
+
+def parse_fecha_registro(value):
+    """Convierte FECHA_DE_REGISTRO ('dd-mm-YYYY HH:MM:SS' o 'dd-mm-YYYY') a datetime, o None."""
+    for fmt in ('%d-%m-%Y %H:%M:%S', '%d-%m-%Y'):
+        try:
+            return datetime.strptime(str(value or ''), fmt)
+        except ValueError:
+            continue
+    return None
+
+
+def _fecha_iso(value):
+    """FECHA_DE_REGISTRO en formato ISO para poder ordenar e indexar."""
+    fecha = parse_fecha_registro(value)
+    return fecha.strftime('%Y-%m-%d %H:%M:%S') if fecha else None
+
+
+class SQLiteReplica:
+    """
+    Réplica de las hojas de Google Sheets en un archivo SQLite.
+
+    Con el backend de Sheets, Google Sheets sigue siendo la fuente de verdad:
+    GoogleSheetManager escribe primero en la hoja y luego aplica el mismo cambio aquí.
+    Las lecturas de listados, dashboard y certificados individuales se resuelven con
+    consultas indexadas sobre este archivo, compartido por todos los workers de gunicorn
+    (modo WAL). Con STORAGE_BACKEND=sqlite este mismo archivo es la fuente de verdad
+    (ver SQLiteBackend) y `sheet_row` pasa a ser solo el identificador de cada fila.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+        # (filtros, versión de la hoja) -> total de certificados que los cumplen.
+        self._totals = {}
+        conn = self._connection()
+        summary_exists = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'resumen_certificados'"
+        ).fetchone()
+        with conn:
+            conn.executescript(SCHEMA)
+        with conn:
+            self._create_triggers(conn, SUMMARY_TRIGGERS)
+            if not summary_exists:
+                self._rebuild_summary(conn)
+        self.search_index = self._create_search_index()
+
+    def _create_search_index(self):
+        """Crea el índice de búsqueda (y lo llena si la réplica ya tenía certificados)."""
+        conn = self._connection()
+        exists = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'certificados_busqueda'"
+        ).fetchone()
+        try:
+            with conn:
+                conn.execute(SEARCH_INDEX)
+                self._create_triggers(conn, SEARCH_INDEX_TRIGGERS)
+                if not exists:
+                    self._rebuild_search_index(conn)
+        except sqlite3.OperationalError as e:
+            # SQLite anterior a 3.34 o compilado sin FTS5: la búsqueda sigue funcionando sin índice.
+            print(f"Advertencia: Índice de búsqueda no disponible ({e}); se recorrerán los certificados.")
+            return False
+        return True
+
+    @staticmethod
+    def _create_triggers(conn, triggers):
+        for sql in triggers.values():
+            conn.execute(sql)
+
+    @staticmethod
+    def _rebuild_search_index(conn):
+        conn.execute("INSERT INTO certificados_busqueda (certificados_busqueda) VALUES ('rebuild')")
+
+    @staticmethod
+    def _rebuild_summary(conn):
+        conn.execute('DELETE FROM resumen_certificados')
+        conn.execute(
+            'INSERT INTO resumen_certificados (producto, dia, conclusion, total) '
+            f"SELECT {_SUMMARY_KEY.format('certificados')}, COUNT(*) FROM certificados GROUP BY 1, 2, 3"
+        )
+
+    def _connection(self):
+        # sqlite3 no permite compartir conexiones entre hilos, así que se abre una por hilo,
+        # y tampoco entre procesos: tras un fork (gunicorn --preload) el hijo abre la suya.
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            if conn is not None:
+                # La heredada no se cierra desde el hijo (SQLite lo desaconseja): solo se deja de usar.
+                _inherited_connections.append(conn)
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            # INSERT OR REPLACE solo dispara los triggers de borrado (que mantienen el
+            # índice de búsqueda) con recursive_triggers activado.
+            conn.execute('PRAGMA recursive_triggers=ON')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    # --- CERTIFICADOS ---
+    @staticmethod
+    def _record_params(sheet_row, record):
+        fecha = _fecha_iso(record.get('FECHA_DE_REGISTRO'))
+        # Se incluye la fecha ISO en el texto de búsqueda para mantener el comportamiento
+        # anterior, en el que la fecha convertida también formaba parte del registro.
+        search_text = '\n'.join(str(v).lower() for v in record.values())
+        if fecha:
+            search_text += '\n' + fecha
+        return (sheet_row, record.get('CODIGO', ''), record.get('PRODUCTO', ''),
+                record.get('CONCLUSION', ''), fecha, search_text,
+                json.dumps(dict(record), ensure_ascii=False))
+
+    def replace_records(self, records, read_started_at=None):
+        """
+        Reemplaza todos los certificados (recarga completa). La fila 1 es la de encabezados.
+
+        La réplica la comparten todos los workers. Con `read_started_at` (time.time() de
+        cuando se empezó a leer la hoja), si otro proceso escribió certificados después
+        de ese momento la lectura puede estar desactualizada respecto a la réplica, así
+        que no se aplica (devuelve False) para no deshacer esos cambios. La siguiente
+        recarga sin escrituras concurrentes recoge lo que se haya cambiado en la hoja.
+
+        Todo ocurre en una sola transacción (BEGIN IMMEDIATE) y los triggers del índice de
+        búsqueda y de los recuentos nunca se quitan: si la recarga falla no queda nada a
+        medias, y el esquema no cambia bajo las conexiones de otros workers. Para que los
+        triggers no encarezcan la recarga solo se escriben las filas cuyo contenido cambió
+        y se borran las que ya no están en la hoja.
+        """
+        conn = self._connection()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            changed_at = self.changed_at('CertificadosDeAnalisis')
+            if read_started_at is not None and changed_at is not None and changed_at > read_started_at:
+                return False
+            current = dict(conn.execute('SELECT sheet_row, data FROM certificados'))
+            changed = []
+            for i, record in enumerate(records):
+                params = self._record_params(i + 2, record)
+                if current.get(i + 2) != params[-1]:
+                    changed.append(params)
+            conn.executemany('INSERT OR REPLACE INTO certificados VALUES (?, ?, ?, ?, ?, ?, ?)', changed)
+            conn.execute('DELETE FROM certificados WHERE sheet_row > ?', (len(records) + 1,))
+            self._mark_synced(conn, 'CertificadosDeAnalisis', len(records))
+        return True
+
+    def upsert_records(self, first_row, records):
+        """Inserta o reemplaza certificados consecutivos empezando en la fila first_row de la hoja."""
+        with self._connection() as conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO certificados VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (self._record_params(first_row + i, r) for i, r in enumerate(records))
+            )
+            self._mark_synced(conn, 'CertificadosDeAnalisis', None)
+
+    def append_record(self, record):
+        """Añade un certificado al final y devuelve la fila asignada (atómico entre procesos)."""
+        conn = self._connection()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            sheet_row = conn.execute('SELECT COALESCE(MAX(sheet_row), 1) + 1 FROM certificados').fetchone()[0]
+            conn.execute('INSERT INTO certificados VALUES (?, ?, ?, ?, ?, ?, ?)',
+                         self._record_params(sheet_row, record))
+            self._mark_synced(conn, 'CertificadosDeAnalisis', None)
+        return sheet_row
+
+    def all_records(self):
+        """Todos los certificados en el orden de la hoja."""
+        rows = self._connection().execute('SELECT data FROM certificados ORDER BY sheet_row').fetchall()
+        return [json.loads(r[0]) for r in rows]
+
+    def record_codigos(self):
+        return [r[0] for r in self._connection().execute('SELECT codigo FROM certificados').fetchall()]
+
+    def get_record_by_codigo(self, codigo):
+        """Devuelve (fila_en_hoja, registro) o (None, None) si el CODIGO no existe."""
+        row = self._connection().execute(
+            'SELECT sheet_row, data FROM certificados WHERE codigo = ? ORDER BY sheet_row LIMIT 1',
+            (str(codigo),)
+        ).fetchone()
+        if not row:
+            return None, None
+        return row[0], json.loads(row[1])
+
+    def query_records(self, search_term='', fecha_inicio=None, fecha_fin=None, producto=None,
+                      require_date=True, limit=None, offset=0):
+        """
+        Filtra certificados con SQL y los devuelve del más reciente al más antiguo.
+
+        El orden sale del índice por fecha de registro (a igual fecha, el último de la
+        hoja primero), así que un rango de fechas se resuelve recorriendo solo ese tramo
+        del índice, sin ordenar. Los certificados sin fecha quedan al final.
+
+        Args:
+            search_term (str): Palabras separadas por espacios; cada una debe aparecer en algún campo.
+            fecha_inicio (date): Fecha mínima de registro (inclusive).
+            fecha_fin (date): Fecha máxima de registro (inclusive).
+            producto (str): Filtra por PRODUCTO exacto.
+            require_date (bool): Excluye registros sin FECHA_DE_REGISTRO válida.
+            limit (int): Máximo de registros a devolver (None = todos).
+            offset (int): Registros a saltar (paginación).
+
+        Returns:
+            tuple: (lista de registros, total de registros que cumplen los filtros)
+        """
+        where, params = self._records_filter(search_term, fecha_inicio, fecha_fin, producto, require_date)
+        where_sql = f"WHERE {' AND '.join(where)}" if where else ''
+
+        conn = self._connection()
+        # La página se lee con LIMIT recorriendo el índice por fecha, así que solo toca las
+        # filas que devuelve; el COUNT(*) sí recorre todas las coincidencias, por eso se
+        # recuerda por combinación de filtros hasta el siguiente cambio en certificados.
+        key = (where_sql, tuple(params), self.changed_at('CertificadosDeAnalisis'))
+        total = self._totals.get(key)
+        if total is None:
+            total = conn.execute(f'SELECT COUNT(*) FROM certificados {where_sql}', params).fetchone()[0]
+            if len(self._totals) >= MAX_CACHED_TOTALS:
+                self._totals.clear()
+            self._totals[key] = total
+        rows = conn.execute(
+            f'SELECT data FROM certificados {where_sql} ORDER BY fecha_registro DESC, sheet_row DESC LIMIT ? OFFSET ?',
+            params + [-1 if limit is None else limit, offset]
+        ).fetchall()
+        return [json.loads(r[0]) for r in rows], total
+
+    def query_records_after(self, search_term='', fecha_inicio=None, fecha_fin=None, producto=None,
+                            after=None, limit=100):
+        """
+        Paginación por cursor (keyset): mismos filtros y orden que query_records, pero en
+        lugar de saltar `offset` filas continúa justo después de la posición `after`, así
+        que una página profunda cuesta lo mismo que la primera. Solo incluye certificados
+        con fecha de registro.
+
+        Args:
+            after (tuple): (fecha_registro ISO, sheet_row) del último certificado ya
+                recibido, o None para empezar por el más reciente.
+            limit (int): Máximo de certificados a devolver.
+
+        Returns:
+            list: [((fecha_registro ISO, sheet_row), registro), ...]
+        """
+        where, params = self._records_filter(search_term, fecha_inicio, fecha_fin, producto, True)
+        if after:
+            where.append('(fecha_registro, sheet_row) < (?, ?)')
+            params.extend(after)
+        rows = self._connection().execute(
+            f"SELECT fecha_registro, sheet_row, data FROM certificados WHERE {' AND '.join(where)} "
+            'ORDER BY fecha_registro DESC, sheet_row DESC LIMIT ?',
+            params + [limit]
+        ).fetchall()
+        return [((r[0], r[1]), json.loads(r[2])) for r in rows]
+
+    def summary_counts(self, producto=None, fecha_inicio=None, fecha_fin=None):
+        """
+        Recuentos de certificados por día de registro y CONCLUSION, leídos de la tabla
+        resumen_certificados (no se recorren los certificados).
+
+        Sin filtro de fechas se incluyen los certificados sin fecha, con día None.
+
+        Returns:
+            dict: {(date o None, conclusion): total}
+        """
+        where, params = ['total > 0'], []
+        if producto:
+            where.append('producto = ?')
+            params.append(producto)
+        if fecha_inicio or fecha_fin:
+            where.append("dia != ''")
+        if fecha_inicio:
+            where.append('dia >= ?')
+            params.append(fecha_inicio.strftime('%Y-%m-%d'))
+        if fecha_fin:
+            where.append('dia <= ?')
+            params.append(fecha_fin.strftime('%Y-%m-%d'))
+        rows = self._connection().execute(
+            f"SELECT dia, conclusion, SUM(total) FROM resumen_certificados WHERE {' AND '.join(where)} "
+            'GROUP BY dia, conclusion',
+            params
+        ).fetchall()
+        return {(date.fromisoformat(dia) if dia else None, conclusion): total for dia, conclusion, total in rows}
+
+    def _records_filter(self, search_term, fecha_inicio, fecha_fin, producto, require_date):
+        """Condiciones WHERE (y sus parámetros) de los filtros de query_records."""
+        where, params = [], []
+        if require_date or fecha_inicio or fecha_fin:
+            where.append('fecha_registro IS NOT NULL')
+        if fecha_inicio:
+            where.append('fecha_registro >= ?')
+            params.append(fecha_inicio.strftime('%Y-%m-%d'))
+        if fecha_fin:
+            where.append('fecha_registro < ?')
+            params.append((fecha_fin + timedelta(days=1)).strftime('%Y-%m-%d'))
+        if producto:
+            where.append('producto = ?')
+            params.append(producto)
+        parts = (search_term or '').lower().split()
+        indexed = [p for p in parts if len(p) >= MIN_INDEXED_TERM] if self.search_index else []
+        if indexed:
+            # Cada término es una frase de trigramas y el AND se resuelve en el índice
+            # (intersección de filas). instr() se sigue aplicando sobre los candidatos
+            # para conservar exactamente la semántica de subcadena.
+            where.append('sheet_row IN (SELECT rowid FROM certificados_busqueda WHERE certificados_busqueda MATCH ?)')
+            params.append(' AND '.join('"{}"'.format(p.replace('"', '""')) for p in indexed))
+        for part in parts:
+            where.append('instr(search_text, ?) > 0')
+            params.append(part)
+        return where, params
+
+    # --- HOJAS DE REFERENCIA ---
+    def replace_reference(self, sheet_name, records):
+        """Reemplaza el contenido de Productos, Usuarios o Maestro Especificaciones."""
+        table, key_columns = REFERENCE_TABLES[sheet_name]
+        columns = ', '.join(['sheet_row'] + [c.lower() for c in key_columns] + ['data'])
+        placeholders = ', '.join('?' * (len(key_columns) + 2))
+        with self._connection() as conn:
+            conn.execute(f'DELETE FROM {table}')
+            conn.executemany(
+                f'INSERT INTO {table} ({columns}) VALUES ({placeholders})',
+                ((i + 2, *[str(r.get(c, '')) for c in key_columns], json.dumps(r, ensure_ascii=False))
+                 for i, r in enumerate(records))
+            )
+            self._mark_synced(conn, sheet_name, len(records))
+
+    def get_reference(self, sheet_name):
+        """Devuelve las filas de una hoja de referencia en el mismo orden que en Google Sheets."""
+        table = REFERENCE_TABLES[sheet_name][0]
+        rows = self._connection().execute(f'SELECT data FROM {table} ORDER BY sheet_row').fetchall()
+        return [json.loads(r[0]) for r in rows]
+
+    def find_reference(self, sheet_name, *values, nocase=False):
+        """
+        Busca una fila de referencia por sus columnas indexadas (en el orden de REFERENCE_TABLES).
+
+        Returns:
+            tuple: (fila, registro) o (None, None) si no existe.
+        """
+        table, key_columns = REFERENCE_TABLES[sheet_name]
+        collate = ' COLLATE NOCASE' if nocase else ''
+        where = ' AND '.join(f'{c.lower()} = ?{collate}' for c in key_columns[:len(values)])
+        row = self._connection().execute(
+            f'SELECT sheet_row, data FROM {table} WHERE {where} ORDER BY sheet_row LIMIT 1',
+            [str(v) for v in values]
+        ).fetchone()
+        if not row:
+            return None, None
+        return row[0], json.loads(row[1])
+
+    def append_reference(self, sheet_name, record):
+        """Añade una fila al final de una hoja de referencia y devuelve la fila asignada."""
+        table, key_columns = REFERENCE_TABLES[sheet_name]
+        conn = self._connection()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            sheet_row = conn.execute(f'SELECT COALESCE(MAX(sheet_row), 1) + 1 FROM {table}').fetchone()[0]
+            self._write_reference(conn, sheet_name, sheet_row, record)
+        return sheet_row
+
+    def upsert_reference(self, sheet_name, sheet_row, record):
+        with self._connection() as conn:
+            self._write_reference(conn, sheet_name, sheet_row, record)
+
+    def delete_reference(self, sheet_name, sheet_row):
+        """Borra una fila de referencia. Las demás conservan su número de fila."""
+        table = REFERENCE_TABLES[sheet_name][0]
+        with self._connection() as conn:
+            conn.execute(f'DELETE FROM {table} WHERE sheet_row = ?', (sheet_row,))
+            self._mark_synced(conn, sheet_name, None)
+
+    def _write_reference(self, conn, sheet_name, sheet_row, record):
+        table, key_columns = REFERENCE_TABLES[sheet_name]
+        columns = ', '.join(['sheet_row'] + [c.lower() for c in key_columns] + ['data'])
+        placeholders = ', '.join('?' * (len(key_columns) + 2))
+        conn.execute(
+            f'INSERT OR REPLACE INTO {table} ({columns}) VALUES ({placeholders})',
+            (sheet_row, *[str(record.get(c, '')) for c in key_columns], json.dumps(record, ensure_ascii=False))
+        )
+        self._mark_synced(conn, sheet_name, None)
+
+    # --- LOG DE ACTIVIDAD ---
+    def append_activity(self, fecha, usuario, accion, detalles):
+        with self._connection() as conn:
+            conn.execute('INSERT INTO actividad (fecha, usuario, accion, detalles) VALUES (?, ?, ?, ?)',
+                         (fecha, usuario, accion, detalles))
+
+    def get_activity(self, limit=500):
+        """Últimas acciones registradas, de la más reciente a la más antigua."""
+        rows = self._connection().execute(
+            'SELECT fecha, usuario, accion, detalles FROM actividad ORDER BY id DESC LIMIT ?', (limit,)
+        ).fetchall()
+        return [{'FECHA': r[0], 'USUARIO': r[1], 'ACCION': r[2], 'DETALLES': r[3]} for r in rows]
+
+    # --- ESTADO DE SINCRONIZACIÓN ---
+    def changed_at(self, sheet_name):
+        """Momento del último cambio conocido de una hoja (sirve como versión para cachés)."""
+        row = self._connection().execute(
+            'SELECT sincronizado_en FROM sync_estado WHERE hoja = ?', (sheet_name,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def mark_changed(self, sheet_name):
+        with self._connection() as conn:
+            self._mark_synced(conn, sheet_name, None)
+
+    @staticmethod
+    def _mark_synced(conn, sheet_name, rows):
+        # rows=None actualiza solo el momento del cambio y conserva el último recuento.
+        conn.execute(
+            'INSERT INTO sync_estado (hoja, sincronizado_en, filas) VALUES (?, ?, ?) '
+            'ON CONFLICT(hoja) DO UPDATE SET sincronizado_en = excluded.sincronizado_en, '
+            'filas = COALESCE(excluded.filas, filas)',
+            (sheet_name, time.time(), rows)
+        )
+
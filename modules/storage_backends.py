@@ -0,0 +1,1025 @@
+import os
+import sys
+import json
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import Counter
+from collections.abc import Mapping
+from array import array
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import islice
+from bisect import bisect_left, insort
+from datetime import datetime, timedelta
+from modules.sqlite_replica import SQLiteReplica, parse_fecha_registro
+from modules.codigo_allocator import CodigoAllocator, parse_codigo
+
+def resource_path(relative_path):
+    try:
+        base_path = sys._MEIPASS
+    except Exception:
+        base_path = os.path.abspath(".")
+    return os.path.join(base_path, relative_path)
+
+# Dónde se guardan los datos de la aplicación:
+#   - 'sheets' (por defecto): Google Sheets, con réplica y cola locales (GoogleSheetManager).
+#   - 'sqlite': el archivo SQLITE_DB_PATH es la fuente de verdad; no necesita credenciales.
+#   - 'memory': todo en memoria del proceso; se pierde al reiniciar. Pensado para pruebas
+#     de carga y benchmarks sin conexión (se precarga con SQLITE_DB_PATH si existe).
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'sheets').lower()
+SQLITE_DB_PATH = os.getenv('SQLITE_DB_PATH', resource_path('data.db'))
+
+USER_COLUMNS = ['USERNAME', 'PASSWORD', 'ROL']
+# Columnas de la hoja Productos, en el orden en que se escriben.
+PRODUCT_COLUMNS = ['PRODUCTO', 'FORMA_FARMACEUTICA', 'PRESENTACION']
+# Nombre de la hoja de certificados en la réplica (sync_estado).
+RECORDS_SHEET = 'CertificadosDeAnalisis'
+
+def get_column_order():
+    cols = ['CODIGO','PRODUCTO','PRESENTACION','LOTE',
+            'VERSION_ESPECIFICACION',
+            'FORMA_FARMACEUTICA','CANTIDAD',
+            'FECHA_PRODUCCION','FECHA_VENCIMIENTO','FECHA_ANALISIS','FECHA_EMISION',
+            'LABORATORIO','REFERENCIA','FECHA_DE_REGISTRO','CONCLUSION',
+            'OBSERVACIONES','CREADO_POR']
+    for i in range(1, 21):
+        cols.extend([f'ENSAYO{i}', f'ESPECIFICACION{i}', f'RESULTADO{i}'])
+    for i in range(1, 21):
+        cols.append(f'NOTA{i}')
+
+    # Debug: Imprimir posición de las NOTAS
+    if False:  # Cambiar a True para debug
+        print("DEBUG - Posiciones de columnas NOTA:")
+        for i in range(1, 21):
+            nota_key = f'NOTA{i}'
+            if nota_key in cols:
+                print(f"  {nota_key}: posición {cols.index(nota_key)}")
+
+    return cols
+
+
+class RecordSchema:
+    """
+    Disposición de columnas de una lectura de la hoja de certificados.
+
+    Se calcula una sola vez por orden de encabezados (ver schema_for): las columnas de
+    la hoja y, al final, las esperadas por get_column_order() que falten en ella.
+    """
+    __slots__ = ('headers', 'width', 'size', 'columns', 'positions')
+
+    def __init__(self, headers):
+        self.headers = tuple(headers)
+        headers = list(headers)
+        present = set(headers)
+        missing = [c for c in get_column_order() if c not in present]
+        self.width = len(headers)
+        self.size = len(headers) + len(missing)
+        # Con encabezados repetidos gana la última columna, igual que dict(zip(...)).
+        self.positions = {c: i for i, c in enumerate(headers + missing)}
+        self.columns = tuple(dict.fromkeys(headers + missing))
+
+    def make(self, row):
+        """Crea el Record de una fila: la recorta al ancho de la hoja y completa con ''."""
+        values = tuple(row[:self.width])
+        return Record(self, values + ('',) * (self.size - len(values)))
+
+
+_schemas = {}
+_schemas_lock = threading.Lock()
+
+
+def schema_for(headers):
+    key = tuple(headers)
+    schema = _schemas.get(key)
+    if schema is None:
+        with _schemas_lock:
+            schema = _schemas.setdefault(key, RecordSchema(key))
+    return schema
+
+
+class Record(Mapping):
+    """
+    Certificado guardado como una tupla de valores más un esquema compartido.
+
+    Ocupa varias veces menos memoria que un dict de ~100 claves por fila y se comporta
+    como un diccionario de solo lectura (get, [], keys, values, items), que es lo que
+    usan las plantillas, los filtros y el generador de PDF. copy() devuelve un dict
+    normal para editarlo o serializarlo (p. ej. con tojson).
+    """
+    __slots__ = ('_schema', '_values')
+
+    def __init__(self, schema, values):
+        self._schema = schema
+        self._values = values
+
+    def __getitem__(self, key):
+        return self._values[self._schema.positions[key]]
+
+    def get(self, key, default=None):
+        position = self._schema.positions.get(key)
+        return default if position is None else self._values[position]
+
+    def __contains__(self, key):
+        return key in self._schema.positions
+
+    def __iter__(self):
+        return iter(self._schema.columns)
+
+    def __len__(self):
+        return len(self._schema.columns)
+
+    def copy(self):
+        return dict(self.items())
+
+    def __repr__(self):
+        return f"Record({self.copy()!r})"
+
+    def __reduce__(self):
+        # Al serializar se guarda solo la tupla de encabezados (compartida por todas las
+        # filas del mismo esquema) y los valores; al restaurar se reutiliza el esquema.
+        return (_restore_record, (self._schema.headers, self._values))
+
+
+def _restore_record(headers, values):
+    return Record(schema_for(headers), values)
+
+
+def record_from_row(data):
+    """Construye el registro a partir de la fila enviada a la hoja.
+
+    Con value_input_option='USER_ENTERED' Google Sheets descarta el apóstrofo inicial
+    (se usa para forzar texto, p. ej. en LOTE), así que se elimina también aquí para
+    que todos los backends guarden lo mismo que devolvería una lectura de la hoja.
+    """
+    values = [v[1:] if isinstance(v, str) and v.startswith("'") else v for v in data]
+    return schema_for(get_column_order()).make(values)
+
+
+def build_product_data(records):
+    processed_data = {}
+    for record in records:
+        producto = record.get('PRODUCTO')
+        if not producto: continue
+        if producto not in processed_data:
+            processed_data[producto] = {
+                "presentaciones": [],
+                "forma": record.get('FORMA_FARMACEUTICA', '')
+            }
+        presentacion = record.get('PRESENTACION')
+        if presentacion:
+            processed_data[producto]["presentaciones"].append(presentacion)
+    return processed_data
+
+
+def build_specs_data(records):
+    specs_data = {}
+    for record in records:
+        producto = record.get('PRODUCTO')
+        version = str(record.get('VER'))
+        descripcion = record.get('DESCRIPCIÓN')
+        especificacion = record.get('ESPECIFICACIÓN')
+        if not all([producto, version, descripcion, especificacion]): continue
+        if producto not in specs_data: specs_data[producto] = {}
+        if version not in specs_data[producto]: specs_data[producto][version] = []
+        specs_data[producto][version].append({"descripcion": descripcion, "especificacion": especificacion})
+    return specs_data
+
+
+class RecordDateIndex:
+    """
+    Fechas de registro de una lista de certificados, convertidas una sola vez, y sus
+    posiciones ordenadas por fecha.
+
+    Un rango de fechas se resuelve con dos búsquedas binarias sobre `entries`, y el
+    orden del más reciente al más antiguo sale de recorrer ese tramo al revés, sin
+    volver a convertir fechas ni ordenar. Las altas (extend) y ediciones (replace)
+    actualizan el índice en el sitio.
+
+    También guarda el total de resultados de cada combinación de filtros ya consultada
+    (ver filter_records), que se descarta con cualquier cambio, y los recuentos por
+    (PRODUCTO, día, CONCLUSION) del dashboard, que se ajustan en cada alta o edición
+    (equivalente en memoria de la tabla resumen_certificados de la réplica).
+
+    Para la búsqueda de texto mantiene además un índice invertido palabra -> posiciones
+    (ver search), que se construye la primera vez que se busca y desde entonces se
+    actualiza en cada alta o edición, como certificados_busqueda en la réplica.
+    """
+
+    def __init__(self, records=()):
+        self.dates = []      # posición -> datetime o None
+        self.entries = []    # (fecha, posición) ordenadas
+        self.undated = []    # posiciones sin fecha válida, en orden de hoja
+        self.groups = []     # posición -> (PRODUCTO, CONCLUSION)
+        self.counts = Counter()
+        self.totals = {}
+        self.words = None    # palabra en minúsculas -> array de posiciones (None hasta la primera búsqueda)
+        self.edited = set()  # posiciones editadas desde que se construyó `words`
+        self.extend(records)
+
+    def __len__(self):
+        return len(self.dates)
+
+    def extend(self, records):
+        self.totals.clear()
+        start = len(self.dates)
+        dates = [parse_fecha_registro(r.get('FECHA_DE_REGISTRO')) for r in records]
+        self.dates.extend(dates)
+        for record, fecha in zip(records, dates):
+            group = (record.get('PRODUCTO', ''), record.get('CONCLUSION', ''))
+            self.groups.append(group)
+            self.counts[_count_key(group, fecha)] += 1
+        dated = [(fecha, start + i) for i, fecha in enumerate(dates) if fecha is not None]
+        self.undated.extend(start + i for i, fecha in enumerate(dates) if fecha is None)
+        if len(dated) == 1:
+            insort(self.entries, dated[0])
+        elif dated:
+            # Las filas nuevas suelen venir ya en orden de fecha: sort() solo intercala tramos.
+            self.entries.extend(dated)
+            self.entries.sort()
+        if self.words is not None:
+            for i, (record, fecha) in enumerate(zip(records, dates)):
+                self._index_words(start + i, record, fecha)
+
+    def append(self, record):
+        self.extend([record])
+
+    def replace(self, position, record):
+        self.totals.clear()
+        previous = self.dates[position]
+        if previous is None:
+            self.undated.remove(position)
+        else:
+            del self.entries[bisect_left(self.entries, (previous, position))]
+        previous_key = _count_key(self.groups[position], previous)
+        self.counts[previous_key] -= 1
+        if not self.counts[previous_key]:
+            del self.counts[previous_key]
+        fecha = parse_fecha_registro(record.get('FECHA_DE_REGISTRO'))
+        self.dates[position] = fecha
+        self.groups[position] = (record.get('PRODUCTO', ''), record.get('CONCLUSION', ''))
+        self.counts[_count_key(self.groups[position], fecha)] += 1
+        if fecha is None:
+            insort(self.undated, position)
+        else:
+            insort(self.entries, (fecha, position))
+        if self.words is not None:
+            # Las palabras antiguas no se quitan de sus listas: search vuelve a comprobar
+            # las posiciones editadas contra el certificado actual.
+            self.edited.add(position)
+            self._index_words(position, record, fecha)
+
+    def _index_words(self, position, record, fecha):
+        for word in _record_words(record, fecha):
+            positions = self.words.get(word)
+            if positions is None:
+                self.words[word] = array('I', (position,))
+            else:
+                positions.append(position)
+
+    def search(self, records, search_parts):
+        """
+        Posiciones de `records` que contienen todas las partes de la búsqueda, con el mismo
+        criterio que recorrerlos (cada parte, subcadena de algún valor o de la fecha).
+
+        Como las partes no tienen espacios, una parte está en un valor si y solo si está
+        dentro de alguna de sus palabras: basta con recorrer el vocabulario, mucho más
+        corto que los certificados, y unir las posiciones de las palabras que la contienen.
+        """
+        if self.words is None:
+            self.words = {}
+            for position, record in enumerate(records):
+                self._index_words(position, record, self.dates[position])
+        found = None
+        for part in search_parts:
+            part_positions = set()
+            for word, positions in self.words.items():
+                if part in word:
+                    part_positions.update(positions)
+            found = part_positions if found is None else found & part_positions
+            if not found:
+                return found
+        for position in self.edited & found:
+            words = _record_words(records[position], self.dates[position])
+            if not all(any(part in word for word in words) for part in search_parts):
+                found.discard(position)
+        return found
+
+    def _bounds(self, fecha_inicio, fecha_fin, before=None):
+        lo = bisect_left(self.entries, (_day_start(fecha_inicio),)) if fecha_inicio else 0
+        hi = bisect_left(self.entries, (_day_start(fecha_fin + timedelta(days=1)),)) if fecha_fin else len(self.entries)
+        if before is not None:
+            hi = min(hi, bisect_left(self.entries, before))
+        return lo, max(lo, hi)
+
+    def positions(self, fecha_inicio=None, fecha_fin=None, require_date=True, before=None):
+        """
+        Recorre (sin copiar) las posiciones con fecha entre fecha_inicio y fecha_fin
+        (inclusive), de la más reciente a la más antigua. Sin filtro de fechas y con
+        require_date=False, los certificados sin fecha van al final.
+
+        Con `before` = (fecha, posición) el recorrido empieza justo después de esa
+        entrada (paginación por cursor) y nunca incluye certificados sin fecha.
+        """
+        lo, hi = self._bounds(fecha_inicio, fecha_fin, before)
+        entries = self.entries
+        for i in range(hi - 1, lo - 1, -1):
+            yield entries[i][1]
+        if not (require_date or fecha_inicio or fecha_fin or before):
+            yield from reversed(self.undated)
+
+    def count(self, fecha_inicio=None, fecha_fin=None, require_date=True):
+        """Cuántas posiciones devolvería positions() con los mismos argumentos."""
+        lo, hi = self._bounds(fecha_inicio, fecha_fin)
+        if not (require_date or fecha_inicio or fecha_fin):
+            return hi - lo + len(self.undated)
+        return hi - lo
+
+
+def _record_words(record, fecha):
+    """Palabras (separadas por espacios) de los valores de un certificado y de su fecha, en minúsculas."""
+    words = set()
+    for value in record.values():
+        words.update(str(value).lower().split())
+    if fecha is not None:
+        words.update(str(fecha).split())
+    return words
+
+
+def _count_key(group, fecha):
+    producto, conclusion = group
+    return producto, fecha.date() if fecha else None, conclusion
+
+
+def summary_counts(date_index, producto=None, fecha_inicio=None, fecha_fin=None):
+    """Versión en memoria de SQLiteReplica.summary_counts, a partir de los recuentos del índice."""
+    result = Counter()
+    for (record_producto, day, conclusion), total in date_index.counts.items():
+        if producto and record_producto != producto: continue
+        if (fecha_inicio or fecha_fin) and day is None: continue
+        if fecha_inicio and day < fecha_inicio: continue
+        if fecha_fin and day > fecha_fin: continue
+        result[(day, conclusion)] += total
+    return dict(result)
+
+
+def _day_start(day):
+    return datetime(day.year, day.month, day.day)
+
+
+# Combinaciones de filtros cuyo total se recuerda por índice (ver filter_records).
+MAX_CACHED_TOTALS = 256
+
+
+def filter_records(records, search_term='', fecha_inicio=None, fecha_fin=None, producto=None,
+                   require_date=True, limit=None, offset=0, date_index=None):
+    """
+    Filtra en memoria una lista de certificados (en orden de hoja) y la devuelve del más
+    reciente al más antiguo. Mismos parámetros y resultado que SQLiteReplica.query_records.
+
+    `date_index` es el RecordDateIndex de `records`; si no se indica se construye aquí.
+
+    Los filtros se encadenan como generadores sobre el índice de fechas y se dejan de
+    recorrer en cuanto la página está completa. El total sale del propio índice cuando
+    solo se filtra por fechas; con búsqueda o producto se cuenta la primera vez que se
+    pide esa combinación y se recuerda en el índice hasta el siguiente cambio.
+    """
+    if date_index is None:
+        date_index = RecordDateIndex(records)
+    search_parts = (search_term or '').lower().split()
+    positions = _matching_positions(records, date_index, search_parts, producto,
+                                    date_index.positions(fecha_inicio, fecha_fin, require_date))
+
+    end = None if limit is None else offset + limit
+    page, seen = [], 0
+    for position in positions if end != 0 else ():
+        if seen >= offset:
+            page.append(records[position])
+        seen += 1
+        if seen == end:
+            break
+    if not (producto or search_parts):
+        return page, date_index.count(fecha_inicio, fecha_fin, require_date)
+
+    key = (tuple(search_parts), producto, fecha_inicio, fecha_fin, require_date)
+    total = date_index.totals.get(key)
+    if total is None:
+        # Se termina de recorrer el mismo generador solo para contar.
+        total = seen + sum(1 for _ in positions)
+        if len(date_index.totals) >= MAX_CACHED_TOTALS:
+            date_index.totals.clear()
+        date_index.totals[key] = total
+    return page, total
+
+
+def filter_records_after(records, search_term='', fecha_inicio=None, fecha_fin=None, producto=None,
+                         after=None, limit=100, date_index=None):
+    """
+    Versión en memoria de SQLiteReplica.query_records_after (paginación por cursor).
+
+    `after` es (fecha_registro ISO, sheet_row) del último certificado ya recibido.
+    """
+    if date_index is None:
+        date_index = RecordDateIndex(records)
+    before = (datetime.fromisoformat(after[0]), after[1] - 2) if after else None
+    positions = _matching_positions(records, date_index, (search_term or '').lower().split(), producto,
+                                    date_index.positions(fecha_inicio, fecha_fin, True, before))
+    return [((date_index.dates[p].strftime('%Y-%m-%d %H:%M:%S'), p + 2), records[p])
+            for p in islice(positions, limit)]
+
+
+def _matching_positions(records, date_index, search_parts, producto, positions):
+    """Encadena sobre `positions` (generador) los filtros por producto y por búsqueda."""
+    if producto:
+        positions = (p for p in positions if records[p].get('PRODUCTO') == producto)
+    if search_parts:
+        found = date_index.search(records, search_parts)
+        positions = (p for p in positions if p in found)
+    return positions
+
+
+def activity_entry(username, action, details):
+    return {'FECHA': datetime.now().strftime('%d-%m-%Y %H:%M:%S'), 'USUARIO': username,
+            'ACCION': action, 'DETALLES': details}
+
+
+class StorageBackend(ABC):
+    """
+    Interfaz común de almacenamiento que usa app.py (certificados, usuarios, productos,
+    especificaciones y log de actividad).
+
+    Cada backend implementa los métodos abstractos; no se puede instanciar uno al que
+    le falte alguno.
+
+    Las filas se identifican como en Google Sheets (la primera fila de datos es la 2),
+    de modo que get_record_by_codigo devuelve una fila que luego acepta update_record.
+    Los métodos que modifican usuarios y productos devuelven (éxito, mensaje); los de
+    certificados lanzan una excepción si la escritura falla.
+
+    Las vistas derivadas del catálogo (lista plana, presentaciones, JSON del formulario,
+    especificaciones por producto) se implementan aquí a partir de product_data y
+    specs_data; cada backend puede sobrescribirlas con versiones cacheadas.
+
+    start_warm_up() precarga en paralelo lo que indique _warm_up_tasks() y marca el
+    backend como listo (is_ready) al terminar, aunque alguna carga falle: lo que no se
+    haya podido precargar se carga a demanda como antes.
+    """
+
+    def __init__(self):
+        self._ready = threading.Event()
+        self._warm_up_pid = None
+        self._warm_up_lock = threading.Lock()
+
+    # --- PRECARGA ---
+    def _warm_up_tasks(self):
+        """Cargas a hacer al arrancar: {nombre: función}. Sin tareas el backend queda listo enseguida."""
+        return {}
+
+    def _restore_snapshot(self):
+        """Restaura los datos desde una copia local. Devuelve True si el backend ya puede atender."""
+        return False
+
+    def start_warm_up(self):
+        """Lanza la precarga en segundo plano (una vez por proceso)."""
+        with self._warm_up_lock:
+            # Tras un fork (gunicorn --preload) el hilo del proceso padre no existe en el hijo.
+            if self._warm_up_pid == os.getpid() or self._ready.is_set():
+                return
+            self._warm_up_pid = os.getpid()
+        # Con una copia local de los datos se atiende de inmediato y la precarga solo revalida.
+        try:
+            if self._restore_snapshot():
+                self._ready.set()
+        except Exception as e:
+            print(f"Advertencia: No se pudo restaurar la copia local de datos: {e}")
+        threading.Thread(target=self._run_warm_up, name='storage-warm-up', daemon=True).start()
+
+    def _run_warm_up(self):
+        started = time.monotonic()
+        tasks = self._warm_up_tasks()
+        if tasks:
+            with ThreadPoolExecutor(max_workers=len(tasks), thread_name_prefix='warm-up') as pool:
+                futures = {pool.submit(task): name for name, task in tasks.items()}
+                for future in as_completed(futures):
+                    try:
+                        future.result()
+                    except Exception as e:
+                        print(f"Advertencia: Falló la precarga de {futures[future]}; se cargará a demanda: {e}")
+            print(f"Precarga de datos completada en {time.monotonic() - started:.1f} s.")
+        self._ready.set()
+
+    @property
+    def is_ready(self):
+        return self._ready.is_set()
+
+    def wait_until_ready(self, timeout=None):
+        """Espera a que termine la precarga (la lanza si este proceso aún no lo hizo). Devuelve is_ready."""
+        if not self._ready.is_set():
+            self.start_warm_up()
+            self._ready.wait(timeout)
+        return self._ready.is_set()
+
+    # --- CERTIFICADOS ---
+    @property
+    @abstractmethod
+    def records_version(self):
+        """Valor que cambia con cada modificación de los certificados."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_all_records(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def query_records(self, search_term='', fecha_inicio=None, fecha_fin=None, producto=None,
+                      require_date=True, limit=None, offset=0):
+        """Ver SQLiteReplica.query_records. Devuelve (registros de la página, total filtrado)."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def query_records_after(self, search_term='', fecha_inicio=None, fecha_fin=None, producto=None,
+                            after=None, limit=100):
+        """Ver SQLiteReplica.query_records_after. Devuelve [((fecha ISO, fila), registro), ...]."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def summary_counts(self, producto=None, fecha_inicio=None, fecha_fin=None):
+        """Ver SQLiteReplica.summary_counts. Devuelve {(día, CONCLUSION): total}."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_record_by_codigo(self, codigo, fresh=False):
+        """Devuelve (fila, registro) del certificado con ese CODIGO, o (None, None)."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_next_codigo(self):
+        """Código que recibirá el próximo certificado, sin reservarlo."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def allocate_codigo(self):
+        """Reserva el código del nuevo certificado."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def add_record(self, data):
+        """Añade un certificado; `data` es la fila en el orden de get_column_order()."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def update_record(self, row_index, data):
+        raise NotImplementedError
+
+    def invalidate_records_cache(self):
+        pass
+
+    def sync_headers(self):
+        """Solo tiene sentido en Google Sheets; los backends locales no tienen encabezados."""
+        return True
+
+    # --- USUARIOS ---
+    @abstractmethod
+    def get_all_users(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def find_user(self, username):
+        """Busca un usuario por USERNAME sin distinguir mayúsculas. Devuelve una copia o None."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def add_user(self, user_data):
+        """`user_data` es [USERNAME, PASSWORD, ROL]."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def update_user(self, username, new_data):
+        """`new_data` puede incluir 'ROL' y 'PASSWORD'."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_user(self, username):
+        raise NotImplementedError
+
+    # --- PRODUCTOS Y ESPECIFICACIONES ---
+    @property
+    @abstractmethod
+    def product_data(self):
+        """Catálogo agrupado: {producto: {'presentaciones': [...], 'forma': ...}}."""
+        raise NotImplementedError
+
+    @property
+    @abstractmethod
+    def products_version(self):
+        """Valor que cambia con cada modificación del catálogo de productos."""
+        raise NotImplementedError
+
+    @property
+    @abstractmethod
+    def specs_data(self):
+        """Especificaciones: {producto: {version: [{'descripcion', 'especificacion'}]}}."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def add_product_presentation(self, product_data):
+        """`product_data` es [PRODUCTO, FORMA_FARMACEUTICA, PRESENTACION]."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_product_presentation(self, product_name, presentation):
+        raise NotImplementedError
+
+    def get_product_data_json(self):
+        return json.dumps(self.product_data or {})
+
+    def get_all_products_flat(self):
+        flat_list = []
+        for product_name, data in (self.product_data or {}).items():
+            for presentation in data.get('presentaciones', []):
+                flat_list.append({
+                    'PRODUCTO': product_name,
+                    'PRESENTACION': presentation,
+                    'FORMA_FARMACEUTICA': data.get('forma', '')
+                })
+        return flat_list
+
+    def get_unique_presentations(self):
+        return sorted({item['PRESENTACION'] for item in self.get_all_products_flat()})
+
+    def get_specs(self, producto, version=None):
+        """
+        Especificaciones de un solo producto desde el índice por producto.
+
+        Returns:
+            dict: {version: [especificaciones]} si no se indica versión; si se indica,
+                  {version: [...]} solo con esa versión. Vacío si no hay datos.
+        """
+        versiones = (self.specs_data or {}).get(producto, {})
+        if version is None:
+            return versiones
+        version = str(version)
+        return {version: versiones[version]} if version in versiones else {}
+
+    def quota_headroom(self):
+        """Margen de cuota de la API externa por clase de llamada (vacío si no hay API)."""
+        return {}
+
+    # --- LOG DE ACTIVIDAD ---
+    def log_action(self, username, action, details=""):
+        pass
+
+    def get_activity_log(self):
+        return []
+
+
+class MemoryBackend(StorageBackend):
+    """
+    Backend en memoria del proceso. No persiste nada ni se comparte entre workers,
+    así que solo sirve para pruebas de carga, benchmarks o desarrollo sin conexión.
+    """
+
+    def __init__(self, records=None, users=None, products=None, specs=None, activity=None):
+        super().__init__()
+        self._lock = threading.RLock()
+        self._records = []
+        self._date_index = RecordDateIndex()
+        self._codigo_index = {}
+        self._records_version = 0
+        self._ultimos_codigos = {}
+        for record in records or []:
+            self._append_record(dict(record))
+        # USERNAME en minúsculas -> usuario, en el orden de alta.
+        self._users = {}
+        for user in users or []:
+            self._users.setdefault(str(user.get('USERNAME', '')).lower(), dict(user))
+        self._product_records = [dict(p) for p in products or []]
+        self._product_data = build_product_data(self._product_records)
+        self._products_version = 0
+        self._specs_data = build_specs_data(specs or [])
+        self._activity = list(activity or [])
+
+    @classmethod
+    def from_sqlite(cls, db_path):
+        """Precarga el backend con los datos de un archivo SQLite (réplica o backend SQLite)."""
+        replica = SQLiteReplica(db_path)
+        return cls(
+            records=replica.all_records(),
+            users=replica.get_reference("Usuarios"),
+            products=replica.get_reference("Productos"),
+            specs=replica.get_reference("Maestro Especificaciones"),
+            activity=list(reversed(replica.get_activity())),
+        )
+
+    # --- CERTIFICADOS ---
+    @property
+    def records_version(self):
+        return self._records_version
+
+    def _append_record(self, record):
+        self._records.append(record)
+        self._date_index.append(record)
+        sheet_row = len(self._records) + 1
+        self._codigo_index.setdefault(str(record.get('CODIGO', '')), sheet_row)
+        parsed = parse_codigo(record.get('CODIGO'))
+        if parsed:
+            numero, anio = parsed
+            self._ultimos_codigos[anio] = max(numero, self._ultimos_codigos.get(anio, 0))
+        self._records_version += 1
+        return sheet_row
+
+    def get_all_records(self):
+        with self._lock:
+            return list(self._records)
+
+    def query_records(self, search_term='', fecha_inicio=None, fecha_fin=None, producto=None,
+                      require_date=True, limit=None, offset=0):
+        with self._lock:
+            return filter_records(self._records, search_term, fecha_inicio, fecha_fin, producto,
+                                  require_date, limit, offset, date_index=self._date_index)
+
+    def query_records_after(self, search_term='', fecha_inicio=None, fecha_fin=None, producto=None,
+                            after=None, limit=100):
+        with self._lock:
+            return filter_records_after(self._records, search_term, fecha_inicio, fecha_fin, producto,
+                                        after, limit, date_index=self._date_index)
+
+    def summary_counts(self, producto=None, fecha_inicio=None, fecha_fin=None):
+        with self._lock:
+            return summary_counts(self._date_index, producto, fecha_inicio, fecha_fin)
+
+    def get_record_by_codigo(self, codigo, fresh=False):
+        with self._lock:
+            sheet_row = self._codigo_index.get(str(codigo))
+            if sheet_row is None:
+                return None, None
+            return sheet_row, dict(self._records[sheet_row - 2])
+
+    def get_next_codigo(self):
+        anio = str(datetime.now().year)
+        with self._lock:
+            return f"{self._ultimos_codigos.get(anio, 0) + 1:04d}-{anio}"
+
+    def allocate_codigo(self):
+        anio = str(datetime.now().year)
+        with self._lock:
+            numero = self._ultimos_codigos.get(anio, 0) + 1
+            self._ultimos_codigos[anio] = numero
+        return f"{numero:04d}-{anio}"
+
+    def add_record(self, data):
+        with self._lock:
+            self._append_record(record_from_row(data))
+
+    def update_record(self, row_index, data):
+        record = record_from_row(data)
+        with self._lock:
+            if not 0 <= row_index - 2 < len(self._records):
+                raise Exception(f"No existe la fila {row_index} en los registros")
+            previous_codigo = str(self._records[row_index - 2].get('CODIGO', ''))
+            if self._codigo_index.get(previous_codigo) == row_index:
+                del self._codigo_index[previous_codigo]
+            self._records[row_index - 2] = record
+            self._date_index.replace(row_index - 2, record)
+            self._codigo_index[str(record.get('CODIGO', ''))] = row_index
+            self._records_version += 1
+
+    # --- USUARIOS ---
+    def get_all_users(self):
+        with self._lock:
+            return [dict(user) for user in self._users.values()]
+
+    def find_user(self, username):
+        with self._lock:
+            user = self._users.get(str(username).lower())
+            return dict(user) if user else None
+
+    def add_user(self, user_data):
+        with self._lock:
+            key = str(user_data[0]).lower()
+            if key in self._users:
+                return False, "El nombre de usuario ya existe."
+            self._users[key] = dict(zip(USER_COLUMNS, user_data))
+        return True, "Usuario añadido con éxito."
+
+    def update_user(self, username, new_data):
+        changes = {key: new_data[key] for key in ('ROL', 'PASSWORD') if key in new_data}
+        with self._lock:
+            key = str(username).lower()
+            if key not in self._users:
+                return False, "Usuario no encontrado."
+            self._users[key] = {**self._users[key], **changes}
+        return True, "Usuario actualizado con éxito."
+
+    def delete_user(self, username):
+        with self._lock:
+            if self._users.pop(str(username).lower(), None) is None:
+                return False, "Usuario no encontrado para eliminar."
+        return True, "Usuario eliminado con éxito."
+
+    # --- PRODUCTOS Y ESPECIFICACIONES ---
+    @property
+    def product_data(self):
+        return self._product_data
+
+    @property
+    def products_version(self):
+        return self._products_version
+
+    @property
+    def specs_data(self):
+        return self._specs_data
+
+    def add_product_presentation(self, product_data):
+        with self._lock:
+            key = (product_data[0], product_data[2])
+            if any((p.get('PRODUCTO'), p.get('PRESENTACION')) == key for p in self._product_records):
+                return False, "Esta presentación para este producto ya existe."
+            self._product_records.append(dict(zip(PRODUCT_COLUMNS, product_data)))
+            self._product_data = build_product_data(self._product_records)
+            self._products_version += 1
+        return True, "Presentación de producto añadida con éxito."
+
+    def delete_product_presentation(self, product_name, presentation):
+        with self._lock:
+            for i, record in enumerate(self._product_records):
+                if (record.get('PRODUCTO'), record.get('PRESENTACION')) == (product_name, presentation):
+                    del self._product_records[i]
+                    self._product_data = build_product_data(self._product_records)
+                    self._products_version += 1
+                    return True, "Presentación eliminada con éxito."
+        return False, "No se encontró la presentación a eliminar."
+
+    # --- LOG DE ACTIVIDAD ---
+    def log_action(self, username, action, details=""):
+        with self._lock:
+            self._activity.append(activity_entry(username, action, details))
+
+    def get_activity_log(self):
+        with self._lock:
+            return list(reversed(self._activity))
+
+
+class SQLiteBackend(StorageBackend):
+    """
+    Backend con un archivo SQLite como fuente de verdad (mismo esquema que la réplica).
+
+    Todos los workers de gunicorn comparten el archivo, así que cada lectura va a la
+    base salvo el catálogo y las especificaciones, que se cachean mientras no cambie su
+    marca en sync_estado. Un archivo que ya fue réplica del backend de Sheets se puede
+    usar directamente.
+    """
+
+    def __init__(self, db_path):
+        super().__init__()
+        self.replica = SQLiteReplica(db_path)
+        self.codigo_allocator = CodigoAllocator(db_path)
+        self._codigo_allocator_seeded = False
+        self._reference_cache = {}
+        self._lock = threading.Lock()
+
+    # --- CERTIFICADOS ---
+    @property
+    def records_version(self):
+        return self.replica.changed_at(RECORDS_SHEET)
+
+    def get_all_records(self):
+        return self.replica.all_records()
+
+    def query_records(self, search_term='', fecha_inicio=None, fecha_fin=None, producto=None,
+                      require_date=True, limit=None, offset=0):
+        return self.replica.query_records(search_term, fecha_inicio, fecha_fin, producto,
+                                          require_date, limit, offset)
+
+    def query_records_after(self, search_term='', fecha_inicio=None, fecha_fin=None, producto=None,
+                            after=None, limit=100):
+        return self.replica.query_records_after(search_term, fecha_inicio, fecha_fin, producto, after, limit)
+
+    def summary_counts(self, producto=None, fecha_inicio=None, fecha_fin=None):
+        return self.replica.summary_counts(producto, fecha_inicio, fecha_fin)
+
+    def get_record_by_codigo(self, codigo, fresh=False):
+        return self.replica.get_record_by_codigo(str(codigo))
+
+    def _ensure_codigo_allocator_seeded(self):
+        if not self._codigo_allocator_seeded:
+            self.codigo_allocator.seed(self.replica.record_codigos())
+            self._codigo_allocator_seeded = True
+
+    def get_next_codigo(self):
+        self._ensure_codigo_allocator_seeded()
+        return self.codigo_allocator.peek()
+
+    def allocate_codigo(self):
+        self._ensure_codigo_allocator_seeded()
+        return self.codigo_allocator.allocate()
+
+    def add_record(self, data):
+        self.replica.append_record(record_from_row(data))
+
+    def update_record(self, row_index, data):
+        self.replica.upsert_records(row_index, [record_from_row(data)])
+
+    # --- USUARIOS ---
+    def get_all_users(self):
+        return self.replica.get_reference("Usuarios")
+
+    def find_user(self, username):
+        return self.replica.find_reference("Usuarios", username, nocase=True)[1]
+
+    def add_user(self, user_data):
+        try:
+            if self.find_user(user_data[0]):
+                return False, "El nombre de usuario ya existe."
+            self.replica.append_reference("Usuarios", dict(zip(USER_COLUMNS, user_data)))
+            return True, "Usuario añadido con éxito."
+        except Exception as e:
+            return False, f"Error al añadir usuario: {e}"
+
+    def update_user(self, username, new_data):
+        try:
+            row, user = self.replica.find_reference("Usuarios", username, nocase=True)
+            if not row: return False, "Usuario no encontrado."
+            changes = {key: new_data[key] for key in ('ROL', 'PASSWORD') if key in new_data}
+            self.replica.upsert_reference("Usuarios", row, {**user, **changes})
+            return True, "Usuario actualizado con éxito."
+        except Exception as e:
+            return False, f"Error al actualizar usuario: {e}"
+
+    def delete_user(self, username):
+        try:
+            row, _ = self.replica.find_reference("Usuarios", username, nocase=True)
+            if not row: return False, "Usuario no encontrado para eliminar."
+            self.replica.delete_reference("Usuarios", row)
+            return True, "Usuario eliminado con éxito."
+        except Exception as e:
+            return False, f"Error al eliminar usuario: {e}"
+
+    # --- PRODUCTOS Y ESPECIFICACIONES ---
+    def _cached_reference(self, sheet_name, build):
+        """Datos derivados de una hoja de referencia, recalculados solo si la hoja cambió."""
+        marca = self.replica.changed_at(sheet_name)
+        with self._lock:
+            cached = self._reference_cache.get(sheet_name)
+            if cached is None or cached[0] != marca:
+                cached = (marca, build(self.replica.get_reference(sheet_name)))
+                self._reference_cache[sheet_name] = cached
+            return cached[1]
+
+    @property
+    def product_data(self):
+        return self._cached_reference("Productos", build_product_data)
+
+    @property
+    def products_version(self):
+        return self.replica.changed_at("Productos")
+
+    @property
+    def specs_data(self):
+        return self._cached_reference("Maestro Especificaciones", build_specs_data)
+
+    def add_product_presentation(self, product_data):
+        try:
+            row, _ = self.replica.find_reference("Productos", product_data[0], product_data[2])
+            if row:
+                return False, "Esta presentación para este producto ya existe."
+            self.replica.append_reference("Productos", dict(zip(PRODUCT_COLUMNS, product_data)))
+            return True, "Presentación de producto añadida con éxito."
+        except Exception as e:
+            return False, f"Error al añadir producto: {e}"
+
+    def delete_product_presentation(self, product_name, presentation):
+        try:
+            row, _ = self.replica.find_reference("Productos", product_name, presentation)
+            if not row:
+                return False, "No se encontró la presentación a eliminar."
+            self.replica.delete_reference("Productos", row)
+            return True, "Presentación eliminada con éxito."
+        except Exception as e:
+            return False, f"Error al eliminar la presentación: {e}"
+
+    # --- LOG DE ACTIVIDAD ---
+    def log_action(self, username, action, details=""):
+        try:
+            entry = activity_entry(username, action, details)
+            self.replica.append_activity(entry['FECHA'], entry['USUARIO'], entry['ACCION'], entry['DETALLES'])
+        except Exception as e:
+            print(f"Advertencia: No se pudo registrar la acción en el log: {e}")
+
+    def get_activity_log(self):
+        return self.replica.get_activity()
+
+
+def create_storage_backend(kind=None):
+    """Crea el backend indicado (por defecto, el de STORAGE_BACKEND)."""
+    kind = (kind or STORAGE_BACKEND).lower()
+    if kind == 'sheets':
+        # Se importa aquí para que los backends locales funcionen sin gspread instalado.
+        from modules.google_sheets_manager import GoogleSheetManager
+        return GoogleSheetManager()
+    if kind == 'sqlite':
+        return SQLiteBackend(SQLITE_DB_PATH)
+    if kind == 'memory':
+        if os.path.exists(SQLITE_DB_PATH):
+            return MemoryBackend.from_sqlite(SQLITE_DB_PATH)
+        return MemoryBackend()
+    raise ValueError(f"STORAGE_BACKEND desconocido: {kind} (use 'sheets', 'sqlite' o 'memory')")
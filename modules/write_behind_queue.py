@@ -0,0 +1,321 @@
+import sqlite3
+import threading
+import atexit
+import json
+import os
+import socket
+import time
+
+# Conexiones abiertas antes de un fork; se conservan para que el recolector no las cierre en el hijo.
+_inherited_connections = []
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS escrituras_pendientes (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    hoja TEXT NOT NULL,
+    operacion TEXT NOT NULL,
+    clave TEXT,
+    fila INTEGER,
+    columna INTEGER NOT NULL DEFAULT 1,
+    valores TEXT NOT NULL,
+    propietario TEXT NOT NULL,
+    creado_en REAL NOT NULL,
+    en_envio_desde REAL
+);
+CREATE INDEX IF NOT EXISTS idx_escrituras_hoja_clave ON escrituras_pendientes (hoja, clave);
+
+-- Último latido de cada proceso con escrituras en el diario (ver HEARTBEAT_INTERVAL).
+CREATE TABLE IF NOT EXISTS latidos_cola (
+    propietario TEXT PRIMARY KEY,
+    latido_en REAL NOT NULL
+);
+"""
+
+# Cada proceso con cola registra un latido cada HEARTBEAT_INTERVAL segundos desde un hilo
+# propio, que sigue latiendo aunque un envío lleve minutos esperando cuota o reintentando.
+# Las escrituras de un propietario sin latido en ORPHAN_TIMEOUT segundos se consideran
+# huérfanas (el proceso terminó sin confirmarlas) y cualquier otro puede enviarlas; las
+# de un proceso vivo nunca se reclaman, por lento que sea su envío.
+HEARTBEAT_INTERVAL = 10
+ORPHAN_TIMEOUT = 60
+
+
+def _column_letter(column):
+    """Letra de la columna `column` (1 = A) para la notación A1."""
+    letters = ''
+    while column:
+        column, remainder = divmod(column - 1, 26)
+        letters = chr(65 + remainder) + letters
+    return letters
+
+
+class WriteBehindQueue:
+    """
+    Cola de escrituras diferidas hacia Google Sheets.
+
+    Las altas y modificaciones se guardan primero en un diario SQLite (sobrevive a una
+    caída del proceso) y un hilo en segundo plano las envía agrupadas: las altas
+    consecutivas de una hoja en un solo append_rows y las modificaciones en un solo
+    batch_update. El envío ocurre cada `flush_interval` segundos o en cuanto se juntan
+    `batch_size` escrituras.
+
+    Operaciones:
+        - 'append': fila nueva al final de la hoja. `clave` identifica el elemento
+          (CODIGO o USERNAME) para poder fusionar cambios posteriores antes del envío.
+        - 'update': escribe `valores` en la fila `fila` (ya existente en la hoja) a partir
+          de la columna `columna` (1 = A, la fila completa).
+
+    La entrega es "al menos una vez": si el proceso cae justo después de que Sheets
+    acepte un lote y antes de borrarlo del diario, ese lote se reenvía al reiniciar.
+    """
+
+    def __init__(self, db_path, resolve_worksheet, on_append_flushed=None,
+                 flush_interval=1.0, batch_size=50):
+        """
+        Args:
+            db_path (str): Archivo SQLite del diario.
+            resolve_worksheet (callable): Recibe el título de una hoja y devuelve el worksheet de gspread.
+            on_append_flushed (callable): Se llama con (hoja, clave, fila, valores) por cada alta
+                                          enviada, con la fila real que asignó Google Sheets
+                                          (None si la respuesta no la indica).
+            flush_interval (float): Segundos máximos que una escritura espera en la cola.
+            batch_size (int): Cantidad de escrituras que dispara un envío inmediato.
+        """
+        self.db_path = db_path
+        self.resolve_worksheet = resolve_worksheet
+        self.on_append_flushed = on_append_flushed
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._local = threading.local()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._heartbeat_thread = None
+        self._thread_pid = None
+        with self._connection() as conn:
+            conn.executescript(SCHEMA)
+            # Diarios creados antes de que las modificaciones indicaran su columna inicial.
+            if 'columna' not in {c[1] for c in conn.execute('PRAGMA table_info(escrituras_pendientes)')}:
+                conn.execute('ALTER TABLE escrituras_pendientes ADD COLUMN columna INTEGER NOT NULL DEFAULT 1')
+            # Tras reiniciar un contenedor el proceso puede volver a tener el mismo
+            # host:pid; nada de este proceso está en envío todavía, así que se liberan.
+            conn.execute('UPDATE escrituras_pendientes SET en_envio_desde = NULL WHERE propietario = ?',
+                         (self._owner(),))
+        atexit.register(self._flush_at_exit)
+        if self.pending_count():
+            self._ensure_thread()
+
+    def _connection(self):
+        # Una conexión por hilo y por proceso: tras un fork (gunicorn --preload) el hijo no
+        # debe usar la que abrió el maestro.
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            if conn is not None:
+                # La heredada no se cierra desde el hijo (SQLite lo desaconseja): solo se deja de usar.
+                _inherited_connections.append(conn)
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @staticmethod
+    def _owner():
+        # Identifica al proceso (cada worker de gunicorn tiene el suyo).
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+    def _ensure_thread(self):
+        # Los hilos no sobreviven al fork de gunicorn, así que se arrancan por proceso.
+        if self._thread is not None and self._thread_pid == os.getpid() and self._thread.is_alive():
+            return
+        self._thread_pid = os.getpid()
+        self._beat()
+        self._thread = threading.Thread(target=self._run, name='sheets-write-behind', daemon=True)
+        self._thread.start()
+        self._heartbeat_thread = threading.Thread(target=self._run_heartbeat, name='sheets-write-behind-latido',
+                                                  daemon=True)
+        self._heartbeat_thread.start()
+
+    def _beat(self):
+        now = time.time()
+        with self._connection() as conn:
+            conn.execute(
+                'INSERT INTO latidos_cola (propietario, latido_en) VALUES (?, ?) '
+                'ON CONFLICT(propietario) DO UPDATE SET latido_en = excluded.latido_en',
+                (self._owner(), now)
+            )
+            # Los procesos que ya no laten no necesitan su fila (sus escrituras siguen siendo huérfanas).
+            conn.execute('DELETE FROM latidos_cola WHERE latido_en < ?', (now - 86400,))
+
+    def _run_heartbeat(self):
+        while True:
+            time.sleep(HEARTBEAT_INTERVAL)
+            try:
+                self._beat()
+            except Exception as e:
+                print(f"Advertencia: No se pudo registrar el latido de la cola de escrituras: {e}")
+
+    def _flush_at_exit(self):
+        try:
+            self.flush()
+        except Exception as e:
+            print(f"Quedaron escrituras en el diario local; se enviarán en el próximo arranque: {e}")
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Error al enviar escrituras pendientes a Google Sheets: {e}")
+                time.sleep(min(30, self.flush_interval * 5))
+
+    # --- ENCOLADO ---
+    def enqueue_append(self, sheet_title, key, values):
+        self._insert(sheet_title, 'append', key, None, values)
+
+    def enqueue_update(self, sheet_title, key, row, values, column=1):
+        """Escribe `values` en la fila `row` desde la columna `column`; las demás celdas no se tocan."""
+        self._insert(sheet_title, 'update', key, row, values, column)
+
+    def _insert(self, sheet_title, operation, key, row, values, column=1):
+        with self._connection() as conn:
+            conn.execute(
+                'INSERT INTO escrituras_pendientes (hoja, operacion, clave, fila, columna, valores, propietario, creado_en) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (sheet_title, operation, key, row, column, json.dumps(values, ensure_ascii=False), self._owner(),
+                 time.time())
+            )
+        self._ensure_thread()
+        if self.pending_count() >= self.batch_size:
+            self._wakeup.set()
+
+    def merge_into_pending_append(self, sheet_title, key, values):
+        """
+        Si el alta de `key` todavía no se envió, reemplaza sus valores y devuelve True.
+
+        Así, editar un elemento recién creado no necesita conocer su fila definitiva.
+        Si el alta se está enviando en este momento, se espera a que termine y se
+        devuelve False: el llamador debe encolar una modificación con la fila real.
+        """
+        for _ in range(2):
+            with self._connection() as conn:
+                cursor = conn.execute(
+                    "UPDATE escrituras_pendientes SET valores = ? "
+                    "WHERE hoja = ? AND clave = ? AND operacion = 'append' AND en_envio_desde IS NULL",
+                    (json.dumps(values, ensure_ascii=False), sheet_title, key)
+                )
+                if cursor.rowcount:
+                    return True
+                in_flight = conn.execute(
+                    "SELECT 1 FROM escrituras_pendientes WHERE hoja = ? AND clave = ? AND operacion = 'append'",
+                    (sheet_title, key)
+                ).fetchone()
+            if not in_flight:
+                return False
+            # Esperar a que termine el envío en curso.
+            with self._flush_lock:
+                pass
+        return False
+
+    # --- CONSULTA ---
+    def pending(self, sheet_title):
+        """Escrituras aún no confirmadas de una hoja, en orden, para aplicarlas sobre una lectura."""
+        rows = self._connection().execute(
+            'SELECT operacion, clave, fila, columna, valores FROM escrituras_pendientes WHERE hoja = ? ORDER BY id',
+            (sheet_title,)
+        ).fetchall()
+        return [{'operacion': r[0], 'clave': r[1], 'fila': r[2], 'columna': r[3], 'valores': json.loads(r[4])}
+                for r in rows]
+
+    def has_pending(self, sheet_title, key):
+        """Indica si hay altas o modificaciones de `key` que Google Sheets aún no recibió."""
+        return self._connection().execute(
+            'SELECT 1 FROM escrituras_pendientes WHERE hoja = ? AND clave = ?', (sheet_title, key)
+        ).fetchone() is not None
+
+    def pending_count(self):
+        return self._connection().execute('SELECT COUNT(*) FROM escrituras_pendientes').fetchone()[0]
+
+    # --- ENVÍO ---
+    def flush(self):
+        """Envía a Google Sheets las escrituras propias y las huérfanas. Se puede llamar a mano."""
+        with self._flush_lock:
+            while True:
+                batch = self._claim_batch()
+                if not batch:
+                    return
+                self._send(batch)
+
+    def _claim_batch(self):
+        """
+        Reclama las escrituras propias aún sin enviar y las de procesos sin latido
+        reciente (estén o no en envío). Al reclamarlas pasan a ser de este proceso.
+        """
+        conn = self._connection()
+        now = time.time()
+        owner = self._owner()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            rows = conn.execute(
+                'SELECT id, hoja, operacion, clave, fila, valores, columna FROM escrituras_pendientes e '
+                'WHERE (propietario = ? AND en_envio_desde IS NULL) '
+                '   OR (propietario != ? AND NOT EXISTS ('
+                '       SELECT 1 FROM latidos_cola l WHERE l.propietario = e.propietario AND l.latido_en >= ?)) '
+                'ORDER BY id LIMIT ?',
+                (owner, owner, now - ORPHAN_TIMEOUT, self.batch_size)
+            ).fetchall()
+            if rows:
+                conn.executemany('UPDATE escrituras_pendientes SET en_envio_desde = ?, propietario = ? WHERE id = ?',
+                                 [(now, owner, r[0]) for r in rows])
+        return rows
+
+    def _send(self, batch):
+        # Se agrupan las operaciones consecutivas del mismo tipo sobre la misma hoja,
+        # respetando el orden en que se encolaron.
+        groups = []
+        for row in batch:
+            if groups and groups[-1][0] == (row[1], row[2]):
+                groups[-1][1].append(row)
+            else:
+                groups.append(((row[1], row[2]), [row]))
+
+        for (sheet_title, operation), rows in groups:
+            try:
+                worksheet = self.resolve_worksheet(sheet_title)
+                if operation == 'append':
+                    response = worksheet.append_rows([json.loads(r[5]) for r in rows], value_input_option='USER_ENTERED')
+                    self._notify_appended(sheet_title, rows, response)
+                else:
+                    # Si las mismas celdas se modificaron varias veces, solo se envía la última
+                    # versión, en el lugar de la última modificación para respetar el orden.
+                    latest = {}
+                    for r in rows:
+                        latest.pop((r[4], r[6]), None)
+                        latest[(r[4], r[6])] = json.loads(r[5])
+                    worksheet.batch_update(
+                        [{'range': f'{_column_letter(columna)}{fila}', 'values': [values]}
+                         for (fila, columna), values in latest.items()],
+                        value_input_option='USER_ENTERED'
+                    )
+            except Exception:
+                # Se liberan las escrituras no enviadas para reintentarlas en el próximo ciclo.
+                with self._connection() as conn:
+                    conn.executemany('UPDATE escrituras_pendientes SET en_envio_desde = NULL WHERE id = ?',
+                                     [(r[0],) for r in batch])
+                raise
+            with self._connection() as conn:
+                conn.executemany('DELETE FROM escrituras_pendientes WHERE id = ?', [(r[0],) for r in rows])
+            batch = [r for r in batch if r not in rows]
+
+    def _notify_appended(self, sheet_title, rows, response):
+        if not self.on_append_flushed:
+            return
+        try:
+            updated_range = response['updates']['updatedRange'].split('!')[-1]
+            first_row = int(''.join(ch for ch in updated_range.split(':')[0] if ch.isdigit()))
+        except (KeyError, TypeError, ValueError):
+            first_row = None
+        for i, r in enumerate(rows):
+            self.on_append_flushed(sheet_title, r[3], first_row + i if first_row else None, json.loads(r[5]))